@@ -0,0 +1,110 @@
+"""
+Benchmark importing the same synthetic export in each format the transformer
+reads: JSON and CSV, each uncompressed, gzipped and bzipped. Reports file
+size and rows/sec to read and map every row. Doesn't need Mongo unless
+--insert is given, which also times a full import into a scratch database.
+
+python benchmark_formats.py --rows 200000 --dir /tmp/formats
+"""
+
+import bz2
+import csv
+import gzip
+import json
+import os
+from datetime import datetime
+from time import time
+from optparse import OptionParser
+import chicago311transformer as transformer
+from benchmark_mapper import synthetic_columns, synthetic_rows
+
+FORMATS = ('json', 'json.gz', 'json.bz2', 'csv', 'csv.gz', 'csv.bz2')
+
+
+def open_for_writing(path):
+  if path.endswith('.gz'):
+    return gzip.open(path, 'wb')
+  if path.endswith('.bz2'):
+    return bz2.BZ2File(path, 'wb')
+  return open(path, 'wb')
+
+
+def write_json(thefile, columns, rows):
+  thefile.write('{\n  "meta" : {\n    "view" : {\n      "columns" : %s\n    }\n  },\n  "data" : [ ' % json.dumps(columns))
+  for index, row in enumerate(rows):
+    thefile.write(index and ',\n  ' or '')
+    thefile.write(json.dumps(row))
+  thefile.write(' ]\n}\n')
+
+
+def csv_date(value):
+  if value and len(value) == 19 and value[10] == 'T':
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S').strftime(transformer.CSV_DATETIME_FORMAT)
+  return value
+
+
+def write_csv(thefile, columns, rows):
+  # the portal's CSVs have title-cased headers, US dates and no meta columns
+  data_columns = [index for index, column in enumerate(columns) if column['dataTypeName'] != 'meta_data']
+  writer = csv.writer(thefile)
+  writer.writerow([columns[index]['name'].replace('_', ' ').title() for index in data_columns])
+  for row in rows:
+    writer.writerow([row[index] is not None and csv_date(row[index]) or '' for index in data_columns])
+
+
+def write_export(path, columns, rows):
+  thefile = open_for_writing(path)
+  if '.csv' in path:
+    write_csv(thefile, columns, rows)
+  else:
+    write_json(thefile, columns, rows)
+  thefile.close()
+
+
+def time_reading(path):
+  start = time()
+  thefile, export_format = transformer.open_export(path)
+  columns, rows = transformer.read_export(thefile, export_format)
+  make_document = transformer.make_sr_mapper(columns)
+  count = 0
+  for row in rows:
+    make_document(row)
+    count += 1
+  thefile.close()
+  return count, count / (time() - start)
+
+
+def time_import(path, batch_size):
+  transformer.db[transformer.DB_BASIC_COLLECTION].drop()
+  start = time()
+  transformer.load_srs_from_file(path, batch_size)
+  return transformer.db[transformer.DB_BASIC_COLLECTION].count() / (time() - start)
+
+
+if __name__ == '__main__':
+  parser = OptionParser()
+  parser.add_option('-n', '--rows', type='int', dest='rows', default=100000, help='Number of synthetic rows')
+  parser.add_option('-d', '--dir', dest='dir', default='.', help='Directory to write the exports to')
+  parser.add_option('--insert', action='store_true', dest='insert', default=False,
+    help='Also time importing each file into a scratch database (%s_benchmark)' % transformer.DB_NAME)
+  parser.add_option('-b', '--batchsize', type='int', dest='batch_size', default=transformer.IMPORT_BATCH_SIZE)
+  (options, args) = parser.parse_args()
+
+  print 'Generating %s rows...' % options.rows
+  columns = synthetic_columns()
+  rows = list(synthetic_rows(options.rows))
+  if options.insert:
+    transformer.connect_db(name=transformer.DB_NAME + '_benchmark')
+
+  print '%-10s %12s %14s %14s' % ('Format', 'Size (MB)', 'Read rows/sec', 'Import rows/sec')
+  for export_format in FORMATS:
+    path = os.path.join(options.dir, 'benchmark_export.%s' % export_format)
+    write_export(path, columns, rows)
+    count, read_rate = time_reading(path)
+    assert count == options.rows, 'Read %s of %s rows from %s' % (count, options.rows, path)
+    import_rate = options.insert and time_import(path, options.batch_size) or 0
+    print '%-10s %12.1f %14.0f %14.0f' % (export_format, os.path.getsize(path) / 1048576.0, read_rate, import_rate)
+    os.remove(path)
+
+  if options.insert:
+    transformer.connection.drop_database(transformer.DB_NAME + '_benchmark')
@@ -0,0 +1,93 @@
+"""
+Benchmark area queries (see geo_queries.py) with the 2dsphere index against
+the same queries forced to scan the whole collection, and show which plan
+each uses. Runs against an existing collection or, with --synthetic, a
+scratch database of synthetic requests.
+
+python benchmark_geo.py --synthetic 200000 --queries 50 --radius 400
+python benchmark_geo.py --collection Cases
+"""
+
+import random
+from time import time
+from optparse import OptionParser
+import chicago311transformer as transformer
+import geo_queries
+from benchmark_mapper import synthetic_columns, synthetic_rows
+
+# Roughly the city limits
+CHICAGO_BOUNDS = (41.64, -87.94, 42.02, -87.52)
+
+
+def load_synthetic(collection, count, batch_size=transformer.IMPORT_BATCH_SIZE):
+  collection.drop()
+  make_document = transformer.make_sr_mapper(synthetic_columns())
+  batch = []
+  for row in synthetic_rows(count):
+    batch.append(make_document(row))
+    if len(batch) >= batch_size:
+      collection.insert(batch)
+      batch = []
+  if batch:
+    collection.insert(batch)
+  collection.ensure_index([('location', transformer.pymongo.GEOSPHERE)])
+
+
+def random_points(count, seed=311):
+  rand = random.Random(seed)
+  south, west, north, east = CHICAGO_BOUNDS
+  return [(rand.uniform(south, north), rand.uniform(west, east)) for index in xrange(count)]
+
+
+def time_queries(collection, specs, hint=None):
+  """Average milliseconds per query and the total number of results."""
+  results = 0
+  start = time()
+  for spec in specs:
+    cursor = collection.find(spec, ['_id'])
+    if hint:
+      cursor = cursor.hint(hint)
+    results += len(list(cursor))
+  return (time() - start) * 1000 / len(specs), results
+
+
+def compare(name, collection, specs):
+  indexed, indexed_results = time_queries(collection, specs)
+  scanned, scanned_results = time_queries(collection, specs, [('$natural', 1)])
+  assert indexed_results == scanned_results, 'The index found %s results but a scan found %s' % (indexed_results, scanned_results)
+  plan, examined = geo_queries.query_plan(collection.find(specs[0]))
+  scan_plan, scan_examined = geo_queries.query_plan(collection.find(specs[0]).hint([('$natural', 1)]))
+  print '%s (%s results per query on average):' % (name, indexed_results / len(specs))
+  print '  2dsphere index: %8.2f ms/query  %-30s %s docs examined' % (indexed, plan, examined)
+  print '  full scan:      %8.2f ms/query  %-30s %s docs examined' % (scanned, scan_plan, scan_examined)
+  print '  %.1fx faster with the index' % (scanned / indexed)
+
+
+if __name__ == '__main__':
+  parser = OptionParser()
+  parser.add_option('-c', '--collection', dest='collection', default=transformer.DB_CASES_COLLECTION, help='Collection to query (default %s)' % transformer.DB_CASES_COLLECTION)
+  parser.add_option('--synthetic', type='int', dest='synthetic', default=0,
+    help='Query this many synthetic requests in a scratch database (%s_benchmark) instead' % transformer.DB_NAME)
+  parser.add_option('-n', '--queries', type='int', dest='queries', default=20, help='Number of queries of each kind')
+  parser.add_option('-r', '--radius', type='float', dest='radius', default=500, help='Radius of radius queries in meters')
+  parser.add_option('--box', type='float', dest='box', default=0.01, help='Height and width of bounding box queries in degrees')
+  (options, args) = parser.parse_args()
+
+  if options.synthetic:
+    db = transformer.connect_db(name=transformer.DB_NAME + '_benchmark')
+    print 'Inserting %s synthetic requests...' % options.synthetic
+    load_synthetic(db[options.collection], options.synthetic)
+  else:
+    db = transformer.connect_db()
+  collection = db[options.collection]
+  print '%s documents in %s' % (collection.count(), options.collection)
+
+  points = random_points(options.queries)
+  compare('Within %sm' % options.radius, collection,
+    [geo_queries.radius_spec(latitude, longitude, options.radius) for latitude, longitude in points])
+  half = options.box / 2
+  compare('Within a %s degree box' % options.box, collection,
+    [geo_queries.box_spec(latitude - half, longitude - half, latitude + half, longitude + half) for latitude, longitude in points])
+
+  if options.synthetic:
+    transformer.connection.drop_database(transformer.DB_NAME + '_benchmark')
@@ -0,0 +1,76 @@
+"""
+Micro-benchmark for turning data portal rows into Mongo documents: compares
+make_sr_document() with the compiled mapper from make_sr_mapper() on a
+synthetic export (a million rows by default). Doesn't need Mongo.
+
+python benchmark_mapper.py --rows 1000000
+"""
+
+import random
+from datetime import datetime, timedelta
+from time import time
+from optparse import OptionParser
+import chicago311transformer as transformer
+
+META_COLUMNS = ('sid', 'id', 'position', 'created_at', 'created_meta', 'updated_at', 'updated_meta', 'meta')
+DATA_COLUMNS = ('creation_date', 'status', 'completion_date', 'service_request_number', 'service_request_type',
+  'updated_on', 'follow_on_service_request', 'address', 'zip', 'x_coordinate', 'y_coordinate', 'ward',
+  'police_district', 'community_area', 'latitude', 'longitude')
+
+SERVICE_TYPES = ('Graffiti Removal', 'Tree Trim', 'Tree Debris', 'Rodent Baiting/Rat Complaint',
+  'Street Light - 1/Out', 'Street Lights - All/Out', 'Fly Dumping', 'Stray Animal', 'Building Violation')
+STATUSES = ('Completed', 'Open', 'Completed - Dup', 'Open - Dup')
+
+
+def synthetic_columns():
+  columns = [{'name': name, 'dataTypeName': 'meta_data'} for name in META_COLUMNS]
+  columns.extend([{'name': name, 'dataTypeName': 'text'} for name in DATA_COLUMNS])
+  return columns
+
+
+def synthetic_rows(count, seed=311):
+  """
+  Yield rows shaped like the portal's 311 export. About a third of the
+  request numbers repeat and a fifth of the requests have follow-ons.
+  """
+  rand = random.Random(seed)
+  start = datetime(2011, 1, 1)
+  for index in xrange(count):
+    number = rand.random() < 0.3 and index / 2 or index
+    created = start + timedelta(minutes=rand.randint(0, 1000000))
+    completed = rand.random() < 0.7 and (created + timedelta(days=rand.randint(0, 30))).strftime('%Y-%m-%dT%H:%M:%S') or None
+    follow_on = rand.random() < 0.2 and '11-%08d' % rand.randint(0, count) or 'N/A'
+    located = rand.random() < 0.9
+    yield [index + 1, 'A%07d' % index, index + 1, 1351000000, '392904', 1351000000, '392904', None,
+      created.strftime('%Y-%m-%dT%H:%M:%S'), rand.choice(STATUSES), completed, '11-%08d' % number,
+      rand.choice(SERVICE_TYPES), (created + timedelta(days=31)).strftime('%Y-%m-%dT%H:%M:%S'), follow_on,
+      '%s N STATE ST' % rand.randint(1, 12000), str(rand.randint(60601, 60661)),
+      str(rand.uniform(1100000, 1200000)), str(rand.uniform(1810000, 1950000)), str(rand.randint(1, 50)),
+      str(rand.randint(1, 25)), str(rand.randint(1, 77)),
+      located and str(rand.uniform(41.64, 42.02)) or None, located and str(rand.uniform(-87.94, -87.52)) or None]
+
+
+def time_documents(make_document, rows):
+  start = time()
+  for row in rows:
+    make_document(row)
+  return len(rows) / (time() - start)
+
+
+if __name__ == '__main__':
+  parser = OptionParser()
+  parser.add_option('-n', '--rows', type='int', dest='rows', default=1000000, help='Number of synthetic rows')
+  (options, args) = parser.parse_args()
+
+  print 'Generating %s rows...' % options.rows
+  columns = synthetic_columns()
+  rows = list(synthetic_rows(options.rows))
+  mapper = transformer.make_sr_mapper(columns)
+
+  for row in rows[:1000]:
+    assert transformer.make_sr_document(row, columns) == mapper(row), 'Mapper output differs for %s' % row
+
+  current = time_documents(lambda row: transformer.make_sr_document(row, columns), rows)
+  print 'make_sr_document: %10.0f documents/sec' % current
+  compiled = time_documents(mapper, rows)
+  print 'make_sr_mapper:   %10.0f documents/sec (%.1fx)' % (compiled, compiled / current)
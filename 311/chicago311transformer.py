@@ -6,8 +6,8 @@ Customize the constants at the top of this file to change the DB and
 collections that will be inserted into.
 
 Calling with the --all argument will do all operations. If a file path
-is included after --all, it will parse and import a JSON document
-(if not included, this part will be skipped).
+is included after --all, it will parse and import a JSON or CSV export,
+optionally gzipped or bzipped (if not included, this part will be skipped).
 
 Does the following things:
 -Parse JSON data from the data portal and insert it into Mongo (DB_BASIC_COLLECTION)
@@ -15,17 +15,37 @@ Does the following things:
 -Extract the availbale service types from the requests (DB_SERVICES_COLLECTION)
 -Combine requests and their follow-ons into "Cases" (DB_CASES_COLLECTION)
 
+Requests, combined requests and cases get a GeoJSON point in 'location' and
+a 2dsphere index on it; see geo_queries.py for querying by area.
+
+Each of those is a stage whose progress is recorded in DB_META_COLLECTION;
+if a run is interrupted, --resume picks it up where it stopped instead of
+starting over (and without importing anything twice). Timings and document
+counts for each stage are printed at the end.
+
 NOTE:
 IF IMPORTING DATA FROM A JSON FILE, YOU SHOULD USE THE -u OPTION:
 python -u --file filename.json
 THIS WILL TURN OFF OUTPUT BUFFERING SO YOU CAN ACTUALLY SEE PROGRESS ;)
 """
 
+import bz2
+import csv
+import gzip
 import json
+import os
+import re
+import struct
+import sys
+from itertools import islice
+from multiprocessing import Pool
 import pymongo
+from bson.objectid import ObjectId
 import iso8601
-from time import sleep
+from datetime import datetime
+from time import sleep, time
 from optparse import OptionParser
+import explore_types
 
 DB_HOST = 'localhost'
 DB_PORT = 27017
@@ -34,10 +54,55 @@ DB_BASIC_COLLECTION = 'ServiceRequests'
 DB_SERVICES_COLLECTION = 'Services'
 DB_COMBINED_COLLECTION = 'ServiceRequestsCombined'
 DB_CASES_COLLECTION = 'Cases'
+DB_META_COLLECTION = 'TransformerMeta'
+# Materialized from the cases by explore_types.py
+DB_PATHS_COLLECTION = 'FollowOnPaths'
+
+# Number of requests inserted at a time when importing
+IMPORT_BATCH_SIZE = 1000
+# Bytes read from the export at a time when importing
+IMPORT_READ_SIZE = 1024 * 1024
+# When a batch insert takes longer than THROTTLE_SLOWDOWN times the fastest
+# batch so far, pause for the difference (up to THROTTLE_MAX_PAUSE seconds)
+# so we don't pretty much halt the system
+THROTTLE_SLOWDOWN = 1.5
+THROTTLE_MAX_PAUSE = 10
+# When importing with several workers, split the file into this many
+# chunks per worker so they stay evenly busy
+PARALLEL_CHUNKS_PER_WORKER = 4
+# Parallel imports need one row per line; lines longer than this mean the
+# export isn't formatted that way
+PARALLEL_MAX_LINE = 1024 * 1024
+# Max number of values in a single $in query
+IN_QUERY_SIZE = 1000
+
+# Date formats in the portal's CSV exports
+CSV_DATE_FORMAT = '%m/%d/%Y'
+CSV_DATETIME_FORMAT = '%m/%d/%Y %I:%M:%S %p'
+# CSV headers (after lower-casing and replacing punctuation with "_") that
+# aren't named the same as the JSON export's columns
+CSV_COLUMN_NAMES = {
+  'type_of_service_request': 'service_request_type',
+  'street_address': 'address',
+  'zip_code': 'zip',
+}
 
-# Connect to MONGOMONGOMONGO
-connection = pymongo.Connection(DB_HOST, DB_PORT)
-db = connection[DB_NAME]
+# Portal date columns that become real dates: {portal name: document name}
+DATE_COLUMNS = {
+  'creation_date': 'created',
+  'updated_on': 'updated',
+  'completion_date': 'completed',
+}
+
+# Connect to MONGOMONGOMONGO (see connect_db())
+connection = None
+db = None
+
+def connect_db(host=DB_HOST, port=DB_PORT, name=DB_NAME):
+  global connection, db
+  connection = pymongo.Connection(host, port)
+  db = connection[name]
+  return db
 
 ##################### UTILITIES ######################
 
@@ -53,15 +118,299 @@ def latest(a, b):
   else:
     return a or b
 
+def chunked(items, size=IN_QUERY_SIZE):
+  items = list(items)
+  for index in xrange(0, len(items), size):
+    yield items[index:index + size]
+
+def parse_portal_date(value):
+  """
+  Parse a date from the data portal. They're nearly always formatted like
+  "2012-01-31T13:45:00", which is sliced up directly; anything else goes
+  through iso8601. Either way the result is in UTC, like iso8601's.
+  """
+  if len(value) == 19 and value[4] == '-' and value[10] == 'T':
+    try:
+      return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+        int(value[11:13]), int(value[14:16]), int(value[17:19]), tzinfo=iso8601.iso8601.UTC)
+    except ValueError:
+      pass
+  elif len(value) >= 10 and value[2] == '/' and value[5] == '/':
+    # CSV exports: "01/31/2012" or "01/31/2012 01:45:00 PM"
+    date_format = len(value) > 10 and CSV_DATETIME_FORMAT or CSV_DATE_FORMAT
+    return datetime.strptime(value, date_format).replace(tzinfo=iso8601.iso8601.UTC)
+  return iso8601.parse_date(value)
+
+
+def geo_point(latitude, longitude):
+  """
+  A GeoJSON point for a request's coordinates (note GeoJSON has longitude
+  first), or None if they're missing or not valid coordinates.
+  """
+  try:
+    latitude = float(latitude)
+    longitude = float(longitude)
+  except (TypeError, ValueError):
+    return None
+  if not (-90 <= latitude <= 90 and -180 <= longitude <= 180) or (latitude == 0 and longitude == 0):
+    return None
+  return {'type': 'Point', 'coordinates': [longitude, latitude]}
+
+
+def first_location(docs):
+  """The location of the first of the docs that has one."""
+  for doc in docs:
+    if doc.get('location'):
+      return doc['location']
+  return None
+
+
+def open_export(filename):
+  """
+  Open a data portal export, decompressing it as it's read if it's gzipped
+  or bzipped. Returns the file and its format ('json' or 'csv'), going by
+  the file's extension or, failing that, its first character.
+  """
+  thefile = open(filename, 'rb')
+  magic = thefile.read(3)
+  thefile.close()
+  name = filename.lower()
+  if magic[:2] == '\x1f\x8b' or name.endswith('.gz'):
+    thefile = gzip.open(filename, 'rb')
+    name = name.rsplit('.gz', 1)[0]
+  elif magic == 'BZh' or name.endswith('.bz2'):
+    thefile = bz2.BZ2File(filename, 'rb')
+    name = name.rsplit('.bz2', 1)[0]
+  else:
+    thefile = open(filename, 'rb')
+  
+  if name.endswith('.csv'):
+    export_format = 'csv'
+  elif name.endswith('.json'):
+    export_format = 'json'
+  else:
+    stream = JSONStream(thefile)
+    export_format = stream.peek() == '{' and 'json' or 'csv'
+    thefile.seek(0)
+  return thefile, export_format
+
+
+def read_export(thefile, export_format):
+  """Returns the column definitions and an iterator over the rows of an export."""
+  if export_format == 'csv':
+    return read_csv_export(thefile)
+  return read_socrata_export(thefile)
+
+
+def csv_column_name(header):
+  name = re.sub(r'[^a-z0-9]+', '_', header.strip().lower()).strip('_')
+  return CSV_COLUMN_NAMES.get(name, name)
+
+
+def read_csv_export(thefile):
+  """
+  Read a CSV export from the data portal as a stream. Returns column
+  definitions like a JSON export's (without any meta_data columns) and an
+  iterator over the rows, with empty values as None like in JSON exports.
+  """
+  reader = csv.reader(thefile)
+  columns = [{'name': csv_column_name(header), 'dataTypeName': 'text'} for header in reader.next()]
+  def rows():
+    for row in reader:
+      yield [value and value.decode('utf-8') or None for value in row]
+  return columns, rows()
+
+
+class JSONStream(object):
+  """
+  Reads JSON values one at a time from a file without reading the whole file.
+  """
+  WHITESPACE = re.compile(r'[ \t\n\r]*')
+  decoder = json.JSONDecoder()
+  
+  def __init__(self, thefile, read_size=IMPORT_READ_SIZE):
+    self.file = thefile
+    self.read_size = read_size
+    self.buffer = ''
+    self.pos = 0
+  
+  def fill(self):
+    # drop what's already been read before adding more
+    if self.pos > self.read_size:
+      self.buffer = self.buffer[self.pos:]
+      self.pos = 0
+    data = self.file.read(self.read_size)
+    self.buffer += data
+    return len(data) > 0
+  
+  def peek(self):
+    """Skip whitespace and return the next character ('' at the end of the file)."""
+    while True:
+      self.pos = self.WHITESPACE.match(self.buffer, self.pos).end()
+      if self.pos < len(self.buffer):
+        return self.buffer[self.pos]
+      if not self.fill():
+        return ''
+  
+  def expect(self, char):
+    found = self.peek()
+    if found != char:
+      raise ValueError('Expected %r but found %r' % (char, found))
+    self.pos += 1
+  
+  def value(self):
+    """Read the next object, array or string."""
+    self.peek()
+    while True:
+      try:
+        value, self.pos = self.decoder.raw_decode(self.buffer, self.pos)
+        return value
+      except ValueError:
+        # probably only part of the value has been read so far
+        if not self.fill():
+          raise
+  
+  def offset(self):
+    """The position in the file of the next unread character."""
+    return self.file.tell() - (len(self.buffer) - self.pos)
+
+
+def read_socrata_export(thefile):
+  """
+  Incrementally parse a Socrata row-array JSON export ({"meta": ..., "data": [...]}).
+  Returns the column definitions from meta.view.columns and an iterator that
+  reads the data rows from the file one at a time.
+  """
+  stream = JSONStream(thefile)
+  columns = read_socrata_columns(stream)
+  return columns, stream_socrata_rows(stream)
+
+
+def read_socrata_columns(stream):
+  """
+  Read up to the "data" array of a Socrata export and return the column
+  definitions from meta.view.columns.
+  """
+  stream.expect('{')
+  columns = None
+  while True:
+    key = stream.value()
+    stream.expect(':')
+    if key == 'data':
+      if columns is None:
+        raise ValueError('Expected "meta" before "data" in the export')
+      return columns
+    
+    value = stream.value()
+    if key == 'meta':
+      columns = value['view']['columns']
+    stream.expect(',')
+
+
+def stream_socrata_rows(stream):
+  stream.expect('[')
+  if stream.peek() == ']':
+    return
+  while True:
+    yield stream.value()
+    if stream.peek() == ']':
+      return
+    stream.expect(',')
+
+
+ROW_SEPARATOR = re.compile(r'[\s,]*')
+
+def read_row_lines(thefile, start, end):
+  """
+  Yield (offset, row) for each Socrata data row on a line that starts in the
+  byte range [start, end), stopping at the end of the data array. The
+  portal's exports put each row on its own line (", [ ... ]"), which is what
+  lets an export be split up by byte ranges; anything else is an error.
+  """
+  thefile.seek(start)
+  position = start
+  while position < end:
+    line = thefile.readline(PARALLEL_MAX_LINE)
+    if not line:
+      return
+    if not line.endswith('\n') and len(line) == PARALLEL_MAX_LINE:
+      raise ValueError('Export does not have one row per line (at byte %s)' % position)
+    line_start = position
+    position += len(line)
+    
+    index = ROW_SEPARATOR.match(line).end()
+    if index == len(line):
+      continue
+    if line[index] != '[':
+      # end of the data array
+      return
+    row, index = JSONStream.decoder.raw_decode(line, index)
+    rest = line[ROW_SEPARATOR.match(line, index).end():]
+    if rest and rest[0] != ']':
+      raise ValueError('Export does not have one row per line (at byte %s)' % line_start)
+    yield line_start, row
+
+
+def import_id_prefix():
+  """
+  The first seven bytes of the ObjectIds for one import: the time plus some
+  random bytes, much like normal ObjectIds.
+  """
+  return struct.pack('>I', int(time())) + os.urandom(3)
+
+def import_id(prefix, offset):
+  """
+  An ObjectId that sorts in file order within an import, no matter which
+  worker inserted it (see group_requests()).
+  """
+  return ObjectId(prefix + struct.pack('>Q', offset)[3:])
+
+def import_id_range(prefix, start=0, end=None):
+  """A spec for the import ids from offset start up to (not including) end."""
+  id_range = {'$gte': import_id(prefix, start)}
+  if end is None:
+    id_range['$lte'] = ObjectId(prefix + '\xff' * 5)
+  else:
+    id_range['$lt'] = import_id(prefix, end)
+  return {'_id': id_range}
+
+
+class InsertThrottle(object):
+  """
+  Times batch inserts and pauses after any that are much slower than the
+  fastest so far, so imports go as fast as Mongo can actually absorb.
+  """
+  def __init__(self, slowdown=THROTTLE_SLOWDOWN, max_pause=THROTTLE_MAX_PAUSE):
+    self.slowdown = slowdown
+    self.max_pause = max_pause
+    self.fastest = None
+    self.paused = 0
+  
+  def insert(self, collection, docs):
+    start = time()
+    # wait for the write so the timing reflects how busy Mongo is
+    collection.insert(docs, w=1)
+    elapsed = time() - start
+    if self.fastest is None or elapsed < self.fastest:
+      self.fastest = elapsed
+    pause = min(elapsed - self.fastest * self.slowdown, self.max_pause)
+    if pause > 0:
+      self.paused += pause
+      sleep(pause)
+    return elapsed
+
 
 ################# COLLECTION SETUP ##################
 
 def setup_basic_collection():
   db[DB_BASIC_COLLECTION].ensure_index('service_request_number')
+  # for reading records grouped by request number (and in insertion order)
+  db[DB_BASIC_COLLECTION].ensure_index([('service_request_number', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
   db[DB_BASIC_COLLECTION].ensure_index('created')
   db[DB_BASIC_COLLECTION].ensure_index('updated')
   db[DB_BASIC_COLLECTION].ensure_index('completed')
   db[DB_BASIC_COLLECTION].ensure_index('service_request_type')
+  db[DB_BASIC_COLLECTION].ensure_index([('location', pymongo.GEOSPHERE)])
 
 def setup_combined_collection():
   db[DB_COMBINED_COLLECTION].ensure_index('service_request_number')
@@ -69,11 +418,15 @@ def setup_combined_collection():
   db[DB_COMBINED_COLLECTION].ensure_index('updated')
   db[DB_COMBINED_COLLECTION].ensure_index('completed')
   db[DB_COMBINED_COLLECTION].ensure_index('service_request_type')
+  db[DB_COMBINED_COLLECTION].ensure_index('follow_on_service_request')
+  db[DB_COMBINED_COLLECTION].ensure_index([('location', pymongo.GEOSPHERE)])
 
 def setup_cases_collection():
   db[DB_CASES_COLLECTION].ensure_index('initial_request')
+  db[DB_CASES_COLLECTION].ensure_index('requests.service_request_number')
   db[DB_CASES_COLLECTION].ensure_index('initial_type')
   db[DB_CASES_COLLECTION].ensure_index('created')
+  db[DB_CASES_COLLECTION].ensure_index([('location', pymongo.GEOSPHERE)])
 
 def setup_services_collection():
   db[DB_SERVICES_COLLECTION].ensure_index('service_name')
@@ -82,31 +435,175 @@ def setup_services_collection():
 
 #################### ACTIONS ########################    
 
-def load_srs_from_file(filename):
+def load_srs_from_file(filename, batch_size=IMPORT_BATCH_SIZE, service_codes=None, id_prefix=None, start=0, checkpoint=None):
+  """
+  Import a JSON or CSV export (see open_export()). If service_codes
+  ({service name: code}, see get_service_codes()) is given, requests of
+  known types get their service_request_code as they're imported.
+  
+  If id_prefix is given, each request's _id is import_id(id_prefix, row
+  number), the first `start` rows are skipped and checkpoint (if any) is
+  called with the number of rows imported so far after each batch, so an
+  interrupted import can be picked up again (see run_import()).
+  """
   print 'Reading %s...' % filename
-  thefile = open(filename)
-  entries = json.loads(thefile.read())
-  thefile.close()
-  columns = entries['meta']['view']['columns']
-  chunk_size = len(entries['data']) / 100
-  print 'Importing data in chunks of %s...' % chunk_size
-  chunked_data = []
-  for index, entry in enumerate(entries['data']):
-    chunked_data.append(make_sr_document(entry, columns))
-    
-    # db[DB_BASIC_COLLECTION].insert(make_sr_document(entry, columns))
-    if index > 0 and index % chunk_size == 0:
-      db[DB_BASIC_COLLECTION].insert(chunked_data)
-      chunked_data = []
-      # Need a sleep so we don't pretty much halt the system
-      sleep(2)
-      if (index / chunk_size) % 10 == 0:
-        print '%s%%' % (index / chunk_size),
-      else:
+  thefile, export_format = open_export(filename)
+  columns, rows = read_export(thefile, export_format)
+  make_document = make_sr_mapper(columns, service_codes)
+  print 'Importing data in batches of %s...' % batch_size
+  throttle = InsertThrottle()
+  batch = []
+  batch_count = 0
+  row_number = 0
+  for entry in rows:
+    row_number += 1
+    if row_number <= start:
+      continue
+    doc = make_document(entry)
+    if id_prefix:
+      doc['_id'] = import_id(id_prefix, row_number)
+    batch.append(doc)
+    if len(batch) >= batch_size:
+      throttle.insert(db[DB_BASIC_COLLECTION], batch)
+      if checkpoint:
+        checkpoint(row_number)
+      batch = []
+      batch_count += 1
+      if batch_count % 100 == 0:
+        print batch_count * batch_size,
+      elif batch_count % 10 == 0:
         print '.',
+  
+  if batch:
+    throttle.insert(db[DB_BASIC_COLLECTION], batch)
+    if checkpoint:
+      checkpoint(row_number)
+  thefile.close()
+  print '\nImported %s requests (paused %.1fs for Mongo)' % (batch_count * batch_size + len(batch), throttle.paused)
+
+
+def split_export(filename, workers):
+  """
+  Get the columns of an uncompressed JSON export with one row per line and
+  split its data into byte ranges (about PARALLEL_CHUNKS_PER_WORKER per
+  worker) that start at the beginning of a line. Returns (columns,
+  boundaries), or None if the export can't be split up.
+  """
+  thefile, export_format = open_export(filename)
+  if export_format != 'json' or not isinstance(thefile, file):
+    thefile.close()
+    print 'Only uncompressed JSON exports can be split up'
+    return None
+  
+  stream = JSONStream(thefile)
+  columns = read_socrata_columns(stream)
+  stream.expect('[')
+  data_start = stream.offset()
+  file_size = os.fstat(thefile.fileno()).st_size
+  
+  # the first couple of rows have to be whole rows on lines of their own
+  # (a pretty-printed or minified export can't be split up)
+  try:
+    list(islice(read_row_lines(thefile, data_start, file_size), 2))
+  except ValueError:
+    thefile.close()
+    print 'Export does not have one row per line'
+    return None
+  
+  # split the data into ranges that start at the beginning of a line
+  chunk_count = workers * PARALLEL_CHUNKS_PER_WORKER
+  step = max(1, (file_size - data_start) / chunk_count)
+  boundaries = [data_start]
+  for index in xrange(1, chunk_count):
+    thefile.seek(data_start + index * step)
+    thefile.readline()
+    boundary = thefile.tell()
+    if boundaries[-1] < boundary < file_size:
+      boundaries.append(boundary)
+  boundaries.append(file_size)
+  thefile.close()
+  return columns, boundaries
+
+
+def load_srs_in_parallel(filename, workers, batch_size=IMPORT_BATCH_SIZE, service_codes=None, id_prefix=None, done=(), checkpoint=None, split=None):
+  """
+  Import a Socrata JSON export like load_srs_from_file(), but split it into
+  byte ranges that a pool of worker processes parse, transform and insert.
+  Each worker has its own connection, so there are at most `workers`
+  concurrent bulk inserts. Falls back to a serial import if the export
+  isn't an uncompressed JSON file with one row per line.
+  
+  If id_prefix is given, ranges whose start offsets are in done are
+  skipped, and any requests left over from an interrupted import of the
+  other ranges (with the same id_prefix) are removed before they're
+  imported again. checkpoint (if any) is called with each range's start
+  offset once it's imported. If the export can't be split, it's imported
+  serially with load_srs_from_file(), picking up after the rows already
+  imported with id_prefix, and checkpoint is called with row counts.
+  
+  split is the result of split_export(), if the caller already has it.
+  """
+  print 'Reading %s...' % filename
+  resuming = id_prefix is not None
+  split = split or split_export(filename, workers)
+  if not split:
+    print 'Importing serially'
+    start = 0
+    if resuming:
+      # rows are inserted in order, so the ones already imported are the first ones
+      start = db[DB_BASIC_COLLECTION].find(import_id_range(id_prefix, 1)).count()
+    return load_srs_from_file(filename, batch_size, service_codes, id_prefix, start, checkpoint)
+  columns, boundaries = split
+  
+  id_prefix = id_prefix or import_id_prefix()
+  tasks = []
+  for index in xrange(len(boundaries) - 1):
+    start, end = boundaries[index], boundaries[index + 1]
+    if start in done:
+      continue
+    if resuming:
+      db[DB_BASIC_COLLECTION].remove(import_id_range(id_prefix, start, end))
+    tasks.append((filename, start, end, columns, service_codes, batch_size, id_prefix))
+  
+  print 'Importing data with %s workers in batches of %s...' % (workers, batch_size)
+  pool = Pool(workers)
+  imported = 0
+  for start, count in pool.imap_unordered(import_row_range, tasks):
+    imported += count
+    if checkpoint:
+      checkpoint(start)
+    print imported,
+  pool.close()
+  pool.join()
+  print '\nImported %s requests' % imported
 
 
-def make_sr_document(sr_data, columns):
+def import_row_range(task):
+  """Worker for load_srs_in_parallel(): import the rows in one byte range."""
+  filename, start, end, columns, service_codes, batch_size, id_prefix = task
+  connect_db()
+  make_document = make_sr_mapper(columns, service_codes)
+  throttle = InsertThrottle()
+  thefile = open(filename, 'rb')
+  imported = 0
+  batch = []
+  for offset, row in read_row_lines(thefile, start, end):
+    doc = make_document(row)
+    doc['_id'] = import_id(id_prefix, offset)
+    batch.append(doc)
+    if len(batch) >= batch_size:
+      throttle.insert(db[DB_BASIC_COLLECTION], batch)
+      imported += len(batch)
+      batch = []
+  
+  if batch:
+    throttle.insert(db[DB_BASIC_COLLECTION], batch)
+    imported += len(batch)
+  thefile.close()
+  return start, imported
+
+
+def make_sr_document(sr_data, columns, service_codes=None):
   doc = { 'meta': {} }
   for index, column in enumerate(columns):
     if column['dataTypeName'] == 'meta_data':
@@ -114,9 +611,10 @@ def make_sr_document(sr_data, columns):
     else:
       doc[column['name']] = sr_data[index]
   
-  # add 2D index if lat/long coordinates are present
-  if doc['latitude']:
-    doc['location'] = [float(doc['latitude']), float(doc['longitude'])]
+  # add a GeoJSON point (for the 2dsphere index) if lat/long coordinates are present
+  location = geo_point(doc['latitude'], doc['longitude'])
+  if location:
+    doc['location'] = location
   
   # convert dates to actual dates
   doc['created'] = iso8601.parse_date(doc['creation_date'])
@@ -127,18 +625,82 @@ def make_sr_document(sr_data, columns):
     doc['completed'] = iso8601.parse_date(doc['completion_date'])
     del doc['completion_date']
   
-  # status should be all lower case
-  doc['status'] = doc['status'].lower()
+  # status should be all lower case (CSV exports can leave it blank)
+  doc['status'] = (doc['status'] or '').lower()
   
-  # convert "N/A" follow-ons to None
-  if doc['follow_on_service_request'].lower() == 'n/a':
+  # convert "N/A" (or blank) follow-ons to None
+  if (doc['follow_on_service_request'] or 'n/a').lower() == 'n/a':
     doc['follow_on_service_request'] = None
   
-  # TODO: should set a service_request_code based on service_request_type
+  # set a service_request_code based on service_request_type
+  if service_codes and doc['service_request_type'] in service_codes:
+    doc['service_request_code'] = service_codes[doc['service_request_type']]
 
   return doc
 
 
+def make_sr_mapper(columns, service_codes=None):
+  """
+  Compile a list of Socrata column definitions into a function that turns a
+  data row into the same document make_sr_document() would, without checking
+  every column's type or deleting keys for every row.
+  """
+  column_indexes = {}
+  meta_fields = []
+  data_fields = []
+  for index, column in enumerate(columns):
+    name = column['name']
+    if column['dataTypeName'] == 'meta_data':
+      meta_fields.append((index, name))
+    else:
+      column_indexes[name] = index
+      if name not in DATE_COLUMNS:
+        data_fields.append((index, name))
+  
+  latitude_index = column_indexes['latitude']
+  longitude_index = column_indexes['longitude']
+  created_index = column_indexes['creation_date']
+  updated_index = column_indexes['updated_on']
+  completed_index = column_indexes['completion_date']
+  status_index = column_indexes['status']
+  follow_on_index = column_indexes['follow_on_service_request']
+  type_index = column_indexes['service_request_type']
+  
+  def make_document(sr_data):
+    doc = {'meta': dict([(name, sr_data[index]) for index, name in meta_fields])}
+    for index, name in data_fields:
+      doc[name] = sr_data[index]
+    
+    # add a GeoJSON point (for the 2dsphere index) if lat/long coordinates are present
+    if sr_data[latitude_index]:
+      location = geo_point(sr_data[latitude_index], sr_data[longitude_index])
+      if location:
+        doc['location'] = location
+    
+    # convert dates to actual dates
+    doc['created'] = parse_portal_date(sr_data[created_index])
+    doc['updated'] = parse_portal_date(sr_data[updated_index])
+    if sr_data[completed_index]:
+      doc['completed'] = parse_portal_date(sr_data[completed_index])
+    else:
+      doc['completion_date'] = sr_data[completed_index]
+    
+    # status should be all lower case (CSV exports can leave it blank)
+    doc['status'] = (sr_data[status_index] or '').lower()
+    
+    # convert "N/A" (or blank) follow-ons to None
+    if (sr_data[follow_on_index] or 'n/a').lower() == 'n/a':
+      doc['follow_on_service_request'] = None
+    
+    # set a service_request_code based on service_request_type
+    if service_codes and sr_data[type_index] in service_codes:
+      doc['service_request_code'] = service_codes[sr_data[type_index]]
+    
+    return doc
+  
+  return make_document
+
+
 def extract_services():
   type_names = db[DB_BASIC_COLLECTION].distinct('service_request_type')
   latest_code = db[DB_SERVICES_COLLECTION].find().count()
@@ -159,9 +721,40 @@ def extract_services():
     db[DB_SERVICES_COLLECTION].insert(type_docs)
   
 
-def update_service_codes(collection):
-  for service in db[DB_SERVICES_COLLECTION].find():
-    db[collection].update({'service_request_type': service['service_name']}, {'$set': {'service_request_code': service['service_code']}})
+def get_service_codes():
+  """Get a map of service names to codes from the services collection."""
+  codes = {}
+  for service in db[DB_SERVICES_COLLECTION].find({}, ['service_name', 'service_code']):
+    codes[service['service_name']] = service['service_code']
+  return codes
+
+
+def update_service_codes(collection, service_codes=None, spec=None):
+  """
+  Set service_request_code on every document in a collection (or just those
+  matching spec) from its service_request_type. Each service is a single
+  server-side multi-update that skips documents which already have the
+  right code, so documents coded at import time aren't rewritten.
+  """
+  service_codes = service_codes or get_service_codes()
+  for name, code in service_codes.iteritems():
+    service_spec = dict(spec or {})
+    service_spec.update({'service_request_type': name, 'service_request_code': {'$ne': code}})
+    db[collection].update(service_spec, {'$set': {'service_request_code': code}}, multi=True)
+
+
+def normalize_locations(collection=DB_BASIC_COLLECTION):
+  """
+  Convert locations imported before they were GeoJSON points (arrays of
+  [latitude, longitude]) to points. Combined requests and cases copy their
+  locations from the raw requests, so rebuild them afterward.
+  """
+  for doc in db[collection].find({'location.0': {'$exists': True}}, ['location']):
+    location = geo_point(*doc['location'])
+    if location:
+      db[collection].update({'_id': doc['_id']}, {'$set': {'location': location}})
+    else:
+      db[collection].update({'_id': doc['_id']}, {'$unset': {'location': 1}})
 
 
 def combine_requests():
@@ -184,37 +777,93 @@ def clean_up_combined():
   Update the overall created, updated, completed dates
   """
   for request in db[DB_COMBINED_COLLECTION].find():
-    # make sure the overall status and created/updated/completed times reflect all the records for each ID
-    overall_open = 'open' in request['status']
-    min_create = request['created']
-    max_complete = 'completed' in request and request['completed'] or None
-    max_time = latest(request['updated'], min_create)
-    if 'completed' in request:
-      max_time = latest(request['completed'], max_time)
-    changed = False
-    for record in request['records']:
-      min_create = earliest(record['created'], min_create)
-      if 'completed' in record:
-        max_complete = latest(record['completed'], max_complete)
-      max_time = latest(max_complete, max_time)
-      max_time = latest(record['updated'], max_time)
-      if overall_open and 'completed' in record['status']:
-        overall_open = False
-        request['status'] = record['status']
-        changed = True
-    if request['created'] != min_create:
-      request['created'] = min_create
-      changed = True
-    if request['updated'] != max_time:
-      request['updated'] = max_time
-      changed = True
-    if max_complete and ('completed' not in request or request['completed'] != max_complete):
-      request['completed'] = max_complete
-      changed = True
-    if changed:
+    if summarize_combined(request):
       db[DB_COMBINED_COLLECTION].save(request)
 
 
+def summarize_combined(request):
+  """
+  Make the overall status and created/updated/completed times of a combined
+  request reflect all its records. Returns whether anything changed.
+  """
+  overall_open = 'open' in request['status']
+  min_create = request['created']
+  max_complete = 'completed' in request and request['completed'] or None
+  max_time = latest(request['updated'], min_create)
+  if 'completed' in request:
+    max_time = latest(request['completed'], max_time)
+  changed = False
+  for record in request['records']:
+    min_create = earliest(record['created'], min_create)
+    if 'completed' in record:
+      max_complete = latest(record['completed'], max_complete)
+    max_time = latest(max_complete, max_time)
+    max_time = latest(record['updated'], max_time)
+    if overall_open and 'completed' in record['status']:
+      overall_open = False
+      request['status'] = record['status']
+      changed = True
+  if request['created'] != min_create:
+    request['created'] = min_create
+    changed = True
+  if request['updated'] != max_time:
+    request['updated'] = max_time
+    changed = True
+  if max_complete and ('completed' not in request or request['completed'] != max_complete):
+    request['completed'] = max_complete
+    changed = True
+  return changed
+
+
+def combine_records(records):
+  """
+  Combine all the raw records for one service request into a single
+  document, just as combine_requests() and clean_up_combined() would.
+  """
+  main = { 'records': records }
+  for key, value in records[0].iteritems():
+    main[key] = value
+  # later records may have been geocoded when the first wasn't
+  location = first_location(records)
+  if location:
+    main['location'] = location
+  summarize_combined(main)
+  return main
+
+
+def group_requests(batch_size=IMPORT_BATCH_SIZE, spec=None, checkpoint=None):
+  """
+  Does the work of combine_requests() and clean_up_combined() in one pass:
+  reads the raw records (all, or those matching spec) sorted by request
+  number, combines each group in memory and bulk inserts the results,
+  instead of an update per duplicate record and a save per changed
+  combined request. checkpoint (if any) is called with the last request
+  number inserted after each batch.
+  """
+  throttle = InsertThrottle()
+  sort = [('service_request_number', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)]
+  batch = []
+  records = []
+  for request in db[DB_BASIC_COLLECTION].find(spec).sort(sort):
+    del request['_id']
+    if records and records[0]['service_request_number'] != request['service_request_number']:
+      batch.append(combine_records(records))
+      records = []
+      if len(batch) >= batch_size:
+        throttle.insert(db[DB_COMBINED_COLLECTION], batch)
+        if checkpoint:
+          checkpoint(batch[-1]['service_request_number'])
+        batch = []
+    records.append(request)
+  
+  if records:
+    batch.append(combine_records(records))
+  if batch:
+    throttle.insert(db[DB_COMBINED_COLLECTION], batch)
+    if checkpoint:
+      checkpoint(batch[-1]['service_request_number'])
+
+
 def make_cases():
   """
   Takes the combined requests and compiles cases (sets of requests that led from one to the next) from them.
@@ -255,7 +904,7 @@ def make_cases():
         'address': request['address'],
         'latitude': request['latitude'],
         'longitude': request['longitude'],
-        'location': request['location'],
+        'location': request.get('location'),
         'x': request['x_coordinate'],
         'y': request['y_coordinate'],
         'zip': request['zip'],
@@ -270,77 +919,457 @@ def make_cases():
 
 def refine_cases():
   for case in db[DB_CASES_COLLECTION].find():
-    # order the requests
-    if len(case['requests']) > 1:
-      case['requests'].sort(key=lambda request: request['created'])
-    
-    first = case['requests'][0]
-    last = case['requests'][-1]
-    if 'completed' in last['status'] and last['follow_on_service_request'] == None:
-      case['status'] = last['status']
-    else:
-      case['status'] = 'dup' in last['status'] and 'open - dup' or 'open'
-    
-    case['unending'] = last['follow_on_service_request'] != None
-    case['initial_type'] = first['service_request_type']
-    case['initial_request'] = first['service_request_number']
-    case['created'] = first['created']
-    case['updated'] = None
-    for request in case['requests']:
-      case['updated'] = latest(case['updated'], request['updated'])
-    if 'completed' in case['status']:
-      case['completed'] = last['completed']
-    
+    refine_case(case)
     db[DB_CASES_COLLECTION].save(case)
 
 
+def refine_case(case):
+  """
+  Put a case's requests in order and set its overall status, initial type,
+  initial request and created/updated/completed times.
+  """
+  # order the requests
+  if len(case['requests']) > 1:
+    case['requests'].sort(key=lambda request: request['created'])
+  
+  first = case['requests'][0]
+  last = case['requests'][-1]
+  if 'completed' in last['status'] and last['follow_on_service_request'] == None:
+    case['status'] = last['status']
+  else:
+    case['status'] = 'dup' in last['status'] and 'open - dup' or 'open'
+  
+  case['unending'] = last['follow_on_service_request'] != None
+  case['initial_type'] = first['service_request_type']
+  case['initial_request'] = first['service_request_number']
+  case['created'] = first['created']
+  case['updated'] = None
+  for request in case['requests']:
+    case['updated'] = latest(case['updated'], request['updated'])
+  if 'completed' in case['status']:
+    # some completed requests have no completion date
+    case['completed'] = last.get('completed')
+  return case
+
+
+class RequestLinks(object):
+  """
+  Union-find over service request numbers; requests are linked to their
+  follow-ons, so every request in a case ends up with the same root.
+  """
+  def __init__(self):
+    self.parents = {}
+  
+  def find(self, request_id):
+    parents = self.parents
+    root = parents.setdefault(request_id, request_id)
+    while parents[root] != root:
+      root = parents[root]
+    # point everything on the way straight at the root
+    while request_id != root:
+      parents[request_id], request_id = root, parents[request_id]
+    return root
+  
+  def union(self, a, b):
+    root_a = self.find(a)
+    root_b = self.find(b)
+    if root_a != root_b:
+      self.parents[root_b] = root_a
+    return root_a
+
+
+def make_case(requests):
+  """Create a refined case from all of its combined requests."""
+  case = {
+    'requests': requests,
+    'status': None
+  }
+  refine_case(case)
+  first = case['requests'][0]
+  case.update({
+    'address': first['address'],
+    'latitude': first['latitude'],
+    'longitude': first['longitude'],
+    'location': first_location(case['requests']),
+    'x': first['x_coordinate'],
+    'y': first['y_coordinate'],
+    'zip': first['zip'],
+  })
+  return case
+
+
+def build_cases(batch_size=IMPORT_BATCH_SIZE, spec=None):
+  """
+  Does the work of make_cases() and refine_cases() in memory. One projected
+  pass over the combined requests (all, or those matching spec) links
+  requests and follow-ons with a union-find; a second pass collects each
+  case's requests and bulk inserts the case, refined, as soon as all of
+  them have been seen.
+  Unlike make_cases(), a case's address and location come from its
+  initial request rather than whichever request happened to be read first.
+  """
+  links = RequestLinks()
+  request_ids = []
+  for request in db[DB_COMBINED_COLLECTION].find(spec or {}, ['service_request_number', 'follow_on_service_request']):
+    request_id = request['service_request_number']
+    request_ids.append(request_id)
+    links.find(request_id)
+    if request['follow_on_service_request']:
+      links.union(request_id, request['follow_on_service_request'])
+  
+  # how many requests each case will have
+  case_sizes = {}
+  for request_id in request_ids:
+    root = links.find(request_id)
+    case_sizes[root] = case_sizes.get(root, 0) + 1
+  del request_ids
+  
+  throttle = InsertThrottle()
+  pending = {}
+  batch = []
+  for request in db[DB_COMBINED_COLLECTION].find(spec):
+    del request['_id']
+    root = links.find(request['service_request_number'])
+    requests = pending.setdefault(root, [])
+    requests.append(request)
+    if len(requests) == case_sizes[root]:
+      del pending[root]
+      batch.append(make_case(requests))
+      if len(batch) >= batch_size:
+        throttle.insert(db[DB_CASES_COLLECTION], batch)
+        batch = []
+  
+  if batch:
+    throttle.insert(db[DB_CASES_COLLECTION], batch)
+
+
+################# INCREMENTAL UPDATES ################
+
+def get_watermark():
+  """
+  The latest 'updated' time already imported: the one recorded by the last
+  incremental update or, failing that, the newest raw request.
+  """
+  watermark = db[DB_META_COLLECTION].find_one({'_id': 'watermark'})
+  if watermark:
+    updated = watermark['updated']
+  else:
+    newest = list(db[DB_BASIC_COLLECTION].find({}, ['updated']).sort('updated', pymongo.DESCENDING).limit(1))
+    updated = newest and newest[0]['updated'] or None
+  # Mongo may hand back naive UTC dates; imported ones are aware
+  if updated and updated.tzinfo is None:
+    updated = updated.replace(tzinfo=iso8601.iso8601.UTC)
+  return updated
+
+
+def record_key(doc):
+  """
+  Identifies a raw record: its request number plus the portal's row id or,
+  if the export has none, its creation date.
+  """
+  key = {'service_request_number': doc['service_request_number']}
+  if doc['meta'].get('id'):
+    key['meta.id'] = doc['meta']['id']
+  else:
+    key['created'] = doc['created']
+  return key
+
+
+def upsert_new_records(filename, watermark, service_codes=None):
+  """
+  Upsert the records in an export that were updated since the watermark.
+  Returns the request numbers that changed and the newest 'updated' time.
+  """
+  thefile, export_format = open_export(filename)
+  columns, rows = read_export(thefile, export_format)
+  make_document = make_sr_mapper(columns, service_codes)
+  changed = set()
+  newest = watermark
+  for entry in rows:
+    doc = make_document(entry)
+    if watermark and doc['updated'] < watermark:
+      continue
+    db[DB_BASIC_COLLECTION].update(record_key(doc), doc, upsert=True)
+    changed.add(doc['service_request_number'])
+    newest = latest(doc['updated'], newest)
+  thefile.close()
+  return changed, newest
+
+
+def linked_requests(request_ids):
+  """
+  Find every request number connected to the given ones by follow-ons,
+  whether through the combined requests or through the existing cases.
+  """
+  linked = set(request_ids)
+  frontier = linked
+  while frontier:
+    found = set()
+    for chunk in chunked(frontier):
+      spec = {'$or': [{'service_request_number': {'$in': chunk}}, {'follow_on_service_request': {'$in': chunk}}]}
+      for request in db[DB_COMBINED_COLLECTION].find(spec, ['service_request_number', 'follow_on_service_request']):
+        found.add(request['service_request_number'])
+        found.add(request['follow_on_service_request'])
+      for case in db[DB_CASES_COLLECTION].find({'requests.service_request_number': {'$in': chunk}}, ['requests.service_request_number']):
+        found.update([request['service_request_number'] for request in case['requests']])
+    found.discard(None)
+    frontier = found - linked
+    linked.update(frontier)
+  return linked
+
+
+def update_incrementally(filename, batch_size=IMPORT_BATCH_SIZE):
+  """
+  Import only the records in an export updated since the last import, then
+  rebuild only the combined requests and cases they affect (including cases
+  that must merge because of new follow-on links).
+  """
+  watermark = get_watermark()
+  print 'Importing records updated since %s from %s' % (watermark, filename)
+  changed, newest = upsert_new_records(filename, watermark, get_service_codes())
+  print '%s requests changed' % len(changed)
+  if not changed:
+    return
+  
+  print 'Updating services'
+  extract_services()
+  service_codes = get_service_codes()
+  for chunk in chunked(changed):
+    update_service_codes(DB_BASIC_COLLECTION, service_codes, {'service_request_number': {'$in': chunk}})
+  
+  print 'Rebuilding combined requests'
+  for chunk in chunked(changed):
+    db[DB_COMBINED_COLLECTION].remove({'service_request_number': {'$in': chunk}})
+    group_requests(batch_size, {'service_request_number': {'$in': chunk}})
+  
+  linked = linked_requests(changed)
+  print 'Rebuilding cases for %s linked requests' % len(linked)
+  # follow-on paths are only kept up to date once they've been built
+  update_paths = db[DB_PATHS_COLLECTION].find_one() is not None
+  old_cases = []
+  for chunk in chunked(linked):
+    spec = {'requests.service_request_number': {'$in': chunk}}
+    if update_paths:
+      old_cases.extend(db[DB_CASES_COLLECTION].find(spec, explore_types.PATH_FIELDS))
+    db[DB_CASES_COLLECTION].remove(spec)
+  build_cases(batch_size, {'service_request_number': {'$in': list(linked)}})
+  
+  if update_paths:
+    print 'Updating follow-on paths'
+    # a case can have requests in more than one chunk
+    new_cases = {}
+    for chunk in chunked(linked):
+      for case in db[DB_CASES_COLLECTION].find({'requests.service_request_number': {'$in': chunk}}, explore_types.PATH_FIELDS):
+        new_cases[case['_id']] = case
+    explore_types.update_follow_on_paths(db, old_cases, new_cases.values())
+  
+  db[DB_META_COLLECTION].save({'_id': 'watermark', 'updated': newest})
+
+
+################### STAGE RUNNER #####################
+
+class StageRun(object):
+  """
+  A run of some of the transformer's stages, in order. Which stages are
+  finished, how long they took, how many documents they left and how far
+  the unfinished ones got are all kept in DB_META_COLLECTION, so a run that
+  dies partway through can be resumed (see --resume).
+  """
+  def __init__(self, doc):
+    self.doc = doc
+    self.id_prefix = doc['id_prefix'].decode('hex')
+    self.reports = []
+  
+  @classmethod
+  def start(cls, stages, **options):
+    doc = {
+      '_id': 'run',
+      'stages': stages,
+      'options': options,
+      'progress': dict([(name, {}) for name in stages]),
+      'id_prefix': import_id_prefix().encode('hex'),
+    }
+    db[DB_META_COLLECTION].save(doc)
+    return cls(doc)
+  
+  @classmethod
+  def last(cls):
+    doc = db[DB_META_COLLECTION].find_one({'_id': 'run'})
+    return doc and cls(doc) or None
+  
+  def finished(self):
+    return all([self.doc['progress'][name].get('done') for name in self.doc['stages']])
+  
+  def progress(self, name):
+    return self.doc['progress'][name]
+  
+  def save_progress(self, name, **progress):
+    self.progress(name).update(progress)
+    changes = dict([('progress.%s.%s' % (name, key), value) for key, value in progress.iteritems()])
+    db[DB_META_COLLECTION].update({'_id': 'run'}, {'$set': changes})
+  
+  def add_progress(self, name, key, value):
+    self.progress(name).setdefault(key, []).append(value)
+    db[DB_META_COLLECTION].update({'_id': 'run'}, {'$push': {'progress.%s.%s' % (name, key): value}})
+  
+  def run(self, name, description, collection, function, *args):
+    """
+    Run one stage (unless it already finished) and record its time and the
+    number of documents in the collection it fills.
+    """
+    progress = self.progress(name)
+    if progress.get('done'):
+      print 'Skipping "%s" (finished in an earlier attempt)' % description
+      self.reports.append((name, progress['seconds'], progress['count'], 'earlier'))
+      return
+    print description
+    start = time()
+    function(*args)
+    self.save_progress(name, done=True, seconds=time() - start, count=db[collection].count())
+    self.reports.append((name, progress['seconds'], progress['count'], ''))
+  
+  def report(self):
+    print '\n%-20s %10s %12s' % ('Stage', 'Seconds', 'Documents')
+    for name, seconds, count, note in self.reports:
+      print '%-20s %10.1f %12s %s' % (name, seconds, count, note)
+
+
+def run_import(run, filename, workers, batch_size):
+  """
+  Import stage: imports with ids from the run's id prefix and picks up
+  after the last checkpointed batch (or byte range), removing anything
+  inserted after it.
+  """
+  progress = run.progress('import')
+  service_codes = get_service_codes()
+  split = workers > 1 and split_export(filename, workers)
+  if split:
+    load_srs_in_parallel(filename, workers, batch_size, service_codes, run.id_prefix, progress.get('ranges', []),
+      lambda start: run.add_progress('import', 'ranges', start), split)
+  else:
+    start = progress.get('rows', 0)
+    db[DB_BASIC_COLLECTION].remove(import_id_range(run.id_prefix, start + 1))
+    load_srs_from_file(filename, batch_size, service_codes, run.id_prefix, start,
+      lambda rows: run.save_progress('import', rows=rows))
+  # and make indexes
+  setup_basic_collection()
+
+
+def run_services():
+  setup_services_collection()
+  extract_services()
+
+
+def run_combine(run, batch_size):
+  """
+  Combine stage: rebuilds the combined collection, picking up after the
+  last request number checkpointed.
+  """
+  last_request = run.progress('combine').get('last_request')
+  if last_request is None:
+    db[DB_COMBINED_COLLECTION].remove({})
+    spec = None
+  else:
+    spec = {'service_request_number': {'$gt': last_request}}
+    db[DB_COMBINED_COLLECTION].remove(spec)
+  group_requests(batch_size, spec, lambda request_id: run.save_progress('combine', last_request=request_id))
+  setup_combined_collection()
+
+
+def run_cases(batch_size):
+  """
+  Cases stage: rebuilds the cases collection from scratch (dropping the
+  follow-on paths materialized from it, which explore_types.py rebuilds).
+  """
+  db[DB_CASES_COLLECTION].remove({})
+  db[DB_PATHS_COLLECTION].drop()
+  build_cases(batch_size)
+  setup_cases_collection()
+
+
+def run_refine():
+  # refining can reorder a case's requests, changing its follow-on path
+  refine_cases()
+  db[DB_PATHS_COLLECTION].drop()
+
+
+def run_stages(run):
+  """Run (or resume) the stages of a StageRun and print how they went."""
+  options = run.doc['options']
+  batch_size = options['batch_size']
+  stages = {
+    'import': ('Loading data from %s' % options['file'], DB_BASIC_COLLECTION,
+      run_import, run, options['file'], options['workers'], batch_size),
+    'locations': ('Converting locations to GeoJSON points', DB_BASIC_COLLECTION, normalize_locations),
+    'services': ('Extracting services from requests', DB_SERVICES_COLLECTION, run_services),
+    'reconcile_raw': ('Updating service codes in raw services collection', DB_BASIC_COLLECTION,
+      update_service_codes, DB_BASIC_COLLECTION),
+    'reconcile_combined': ('Updating service codes in combined services collection', DB_COMBINED_COLLECTION,
+      update_service_codes, DB_COMBINED_COLLECTION),
+    'combine': ('De-duplicating service requests', DB_COMBINED_COLLECTION, run_combine, run, batch_size),
+    'cases': ('Combining follow-on requests into cases', DB_CASES_COLLECTION, run_cases, batch_size),
+    'refine': ('Refining case summary data', DB_CASES_COLLECTION, run_refine),
+  }
+  for name in run.doc['stages']:
+    run.run(name, *stages[name])
+  run.report()
+
+
 if __name__ == '__main__':
   parser = OptionParser()
-  parser.add_option('-f', '--file', dest='file', help='A JSON file from Socrata to parse and import')
+  parser.add_option('-f', '--file', dest='file', help='A JSON or CSV export from Socrata (optionally gzipped or bzipped) to parse and import')
+  parser.add_option('-w', '--workers', type='int', dest='workers', default=1, help='Number of processes to import with (default 1)')
+  parser.add_option('-b', '--batchsize', type='int', dest='batch_size', default=IMPORT_BATCH_SIZE, help='Number of requests to insert at a time when importing (default %s)' % IMPORT_BATCH_SIZE)
+  parser.add_option('--locations', action='store_true', dest='locations', help='Convert [latitude, longitude] locations from older imports to GeoJSON points (rebuild combined requests and cases afterward)')
   parser.add_option('-s', '--services', action='store_true', dest='services', help='Extract service types from requests')
   parser.add_option('-r', '--combine', action='store_true', dest='combine', help='Combine multiple records for a single service request')
   parser.add_option('--reconcileservices', action='store_true', dest='reconcile_services', help='Update the service codes in the ServiceRequests collection.')
   parser.add_option('--reconcilecombined', action='store_true', dest='reconcile_combined', help='Update the service codes in the ServiceRequestsCombined collection.')
-  parser.add_option('-c', '--cases', action='store_true', dest='cases', help='Create "cases," or sets of linked/follow-on service requests')
-  parser.add_option('--refinecases', action='store_true', dest='refine_cases', help='Refine the data stored with each case, putting the requests in order, adding initial type, status, etc.')
-  parser.add_option('-a', '--all', action='store_true', dest='all', help='Perform all actions; if a file is provided as a first positional argument, load that JSON')
+  parser.add_option('-c', '--cases', action='store_true', dest='cases', help='Create "cases," or sets of linked/follow-on service requests (already refined)')
+  parser.add_option('--refinecases', action='store_true', dest='refine_cases', help='Refine the data stored with each existing case, putting the requests in order, adding initial type, status, etc.')
+  parser.add_option('-i', '--incremental', action='store_true', dest='incremental', help='Import only records updated since the last import from the file given with --file, and rebuild only the combined requests and cases they affect')
+  parser.add_option('--resume', action='store_true', dest='resume', help='Resume the last run from where it stopped, with the same options, skipping the stages it finished')
+  parser.add_option('-a', '--all', action='store_true', dest='all', help='Perform all actions; if a file is provided as a first positional argument, load that export')
   (options, args) = parser.parse_args()
   
-  if options.file or (options.all and len(args) > 0):
-    file_to_load = options.file or args[0]
-    print 'Loading data from %s' % file_to_load
-    load_srs_from_file(file_to_load)
-    # and make indexes
-    setup_basic_collection()
+  connect_db()
   
-  if options.services or options.all:
-    print 'Extracting services from requests'
-    setup_services_collection()
-    extract_services()
+  if options.incremental:
+    if not options.file:
+      parser.error('--incremental needs a --file to import')
+    update_incrementally(options.file, options.batch_size)
+    sys.exit(0)
   
-  if options.services or options.reconcile_services or options.all:
-    print 'Updating service codes in raw services collection'
-    update_service_codes(DB_SERVICES_COLLECTION)
+  if options.resume:
+    run = StageRun.last()
+    if not run or run.finished():
+      parser.error('There is no unfinished run to resume')
+    print 'Resuming the last run (%s)' % ', '.join(run.doc['stages'])
+    run_stages(run)
+    sys.exit(0)
   
+  stages = []
+  file_to_load = options.file or (options.all and len(args) > 0 and args[0]) or None
+  if file_to_load:
+    stages.append('import')
+  if options.locations:
+    stages.append('locations')
+  if options.services or options.all:
+    stages.append('services')
+  if options.services or options.reconcile_services or options.all:
+    stages.append('reconcile_raw')
   # We do this before creating the combined collection so, if it doesn't
-  # yet exist, it goes fast and doesn't waste time. combine_requests() will
+  # yet exist, it goes fast and doesn't waste time. group_requests() will
   # automatically pick up the reconciled codes from the raw services collection.
   if options.services or options.reconcile_combined or options.all:
-    print 'Updating service codes in combined services collection'
-    update_service_codes(DB_COMBINED_COLLECTION)
-  
+    stages.append('reconcile_combined')
   if options.combine or options.all:
-    print 'De-duplicating service requests'
-    combine_requests()
-    clean_up_combined()
-    setup_combined_collection()
-    
+    stages.append('combine')
   if options.cases or options.all:
-    print 'Combining follow-on requests into cases'
-    make_cases()
-    setup_cases_collection()
-  
-  if options.refine_cases or options.all:
-    print 'Refining case summary data'
-    refine_cases()
-  
\ No newline at end of file
+    stages.append('cases')
+  # cases built above are already refined
+  if options.refine_cases and not (options.cases or options.all):
+    stages.append('refine')
+  
+  if stages:
+    run_stages(StageRun.start(stages, file=file_to_load, workers=options.workers, batch_size=options.batch_size))
@@ -2,17 +2,152 @@
 Tools for exploring the tree of possible follow-ons for any given request type or set of request types.
 """
 
+import cPickle
+import json
+import os
+from array import array
+from collections import Counter, OrderedDict
+from optparse import OptionParser
 import pymongo
 
 DB_HOST = 'localhost'
 DB_PORT = 27017
 DB_NAME = 'TestData'
 
-def check_deepness(db, types, seen_types=None):
+# Where load_follow_on_graph() keeps the graph between runs
+GRAPH_CACHE = 'follow_on_graph.cache'
+# Fields of a case needed to get its path of request types (see case_path())
+PATH_FIELDS = ['initial_type', 'requests.service_request_type']
+
+
+class FollowOnGraph(object):
+  """
+  The request -> follow-on edges of ServiceRequestsCombined, boiled down to
+  what check_deepness() needs for each type: how many requests it has, how
+  many of those have follow-ons and which requests (by index) they're
+  followed by.
+  """
+  def __init__(self, types, request_types, record_counts, followed_counts, targets, stamp=None):
+    self.types = types
+    self.request_types = request_types
+    self.record_counts = record_counts
+    self.followed_counts = followed_counts
+    self.targets = targets
+    self.stamp = stamp
+    self.type_indexes = dict([(name, index) for index, name in enumerate(types)])
+  
+  @classmethod
+  def build(cls, db):
+    """Build the graph from one projected scan of the combined requests."""
+    types = []
+    type_indexes = {}
+    request_indexes = {}
+    request_types = array('i')
+    follows = []
+    fields = ['service_request_number', 'service_request_type', 'follow_on_service_request']
+    for request in db.ServiceRequestsCombined.find({}, fields):
+      type_index = type_indexes.get(request['service_request_type'])
+      if type_index is None:
+        type_index = type_indexes[request['service_request_type']] = len(types)
+        types.append(request['service_request_type'])
+      request_indexes[request['service_request_number']] = len(request_types)
+      request_types.append(type_index)
+      follows.append(request['follow_on_service_request'])
+    
+    record_counts = array('i', [0] * len(types))
+    followed_counts = array('i', [0] * len(types))
+    targets = [set() for name in types]
+    for index, follow_on in enumerate(follows):
+      type_index = request_types[index]
+      record_counts[type_index] += 1
+      if follow_on:
+        followed_counts[type_index] += 1
+        if follow_on in request_indexes:
+          targets[type_index].add(request_indexes[follow_on])
+    targets = [array('i', sorted(type_targets)) for type_targets in targets]
+    return cls(types, request_types, record_counts, followed_counts, targets, graph_stamp(db))
+  
+  @classmethod
+  def load(cls, path):
+    thefile = open(path, 'rb')
+    try:
+      return cls(*cPickle.load(thefile))
+    finally:
+      thefile.close()
+  
+  def save(self, path):
+    thefile = open(path, 'wb')
+    try:
+      cPickle.dump((self.types, self.request_types, self.record_counts, self.followed_counts, self.targets, self.stamp),
+        thefile, cPickle.HIGHEST_PROTOCOL)
+    finally:
+      thefile.close()
+  
+  def deepness(self, types, seen_types=None):
+    """Same as check_deepness(), but answered from the graph."""
+    seen_types = set(seen_types or [])
+    result = None
+    level = None
+    while types:
+      type_indexes = [self.type_indexes[name] for name in set(types) if name in self.type_indexes]
+      following = set()
+      for type_index in type_indexes:
+        following.update(self.targets[type_index])
+      following_types = set([self.types[self.request_types[index]] for index in following])
+      seen_types.update(types)
+      
+      data = {
+        'record_count': sum([self.record_counts[type_index] for type_index in type_indexes]),
+        'followed_types': [self.types[type_index] for type_index in type_indexes if self.followed_counts[type_index]],
+        'following_types': list(following_types),
+        'followed_count': sum([self.followed_counts[type_index] for type_index in type_indexes]),
+        'following_count': len(following),
+        'next': None,
+      }
+      if level:
+        level['next'] = data
+      else:
+        result = data
+      level = data
+      types = list(following_types - seen_types)
+    return result
+
+
+def graph_stamp(db):
+  """Identifies a version of the combined requests (they're rebuilt with new ids)."""
+  newest = list(db.ServiceRequestsCombined.find({}, ['_id']).sort('_id', pymongo.DESCENDING).limit(1))
+  return (db.ServiceRequestsCombined.count(), newest and str(newest[0]['_id']) or None)
+
+
+def load_follow_on_graph(db, path=GRAPH_CACHE, refresh=False):
+  """
+  Load the follow-on graph cached at path, rebuilding it (and the cache) if
+  the combined requests have changed since it was built or if refresh is set.
+  """
+  if path and os.path.exists(path) and not refresh:
+    graph = FollowOnGraph.load(path)
+    if graph.stamp == graph_stamp(db):
+      return graph
+  graph = FollowOnGraph.build(db)
+  if path:
+    graph.save(path)
+  return graph
+
+
+def check_deepness(db, types, seen_types=None, graph=None):
   """
   Recursively identify request types that result as follow-ons from a given set of initial request types.
   db = A database connection to use
   types = A list of request type names (not codes) to start from
+  graph = A FollowOnGraph to answer from (one is loaded with load_follow_on_graph() if not given)
+  """
+  graph = graph or load_follow_on_graph(db)
+  return graph.deepness(types, seen_types)
+
+
+def query_deepness(db, types, seen_types=None):
+  """
+  check_deepness() the old way, straight from the database, level by level.
   """
   overall_count = db.ServiceRequestsCombined.find({'service_request_type': {'$in': types}}).count()
   
@@ -47,19 +182,107 @@ def check_deepness(db, types, seen_types=None):
     'following_types': following_types.keys(),
     'followed_count': followed_count,
     'following_count': following_count,
-    'next': len(deeper_types) and check_deepness(db, deeper_types, seen_types) or None,
+    'next': len(deeper_types) and query_deepness(db, deeper_types, seen_types) or None,
   }
 
 
+def case_path(case):
+  """A case's request types in order, starting with its initial type."""
+  return [case['initial_type']] + [request['service_request_type'] for request in case['requests'][1:]]
+
+
+def count_paths(cases, counts=None, increment=1):
+  """
+  Count the paths of request types in the given cases, and how often each
+  type shows up at each depth, by initial type. Keys are
+  (initial type, path) and (initial type, depth, type) respectively.
+  """
+  path_counts, depth_counts = counts or (Counter(), Counter())
+  for case in cases:
+    path = case_path(case)
+    path_counts[(path[0], tuple(path))] += increment
+    for depth, service_type in enumerate(path[1:]):
+      depth_counts[(path[0], depth + 1, service_type)] += increment
+  return path_counts, depth_counts
+
+
+def build_follow_on_paths(db):
+  """
+  Materialize the paths through every case into the FollowOnPaths
+  collection, from one pass over the cases. There are two kinds of documents:
+  {initial_type, path, count}, for each distinct path (including ones with
+  no follow-ons), and {initial_type, depth, type, count}, for how many cases
+  have a given type at a given depth.
+  """
+  path_counts, depth_counts = count_paths(db.Cases.find({}, PATH_FIELDS))
+  db.FollowOnPaths.drop()
+  docs = [{'initial_type': key[0], 'path': list(key[1]), 'count': count} for key, count in path_counts.iteritems()]
+  docs.extend([{'initial_type': key[0], 'depth': key[1], 'type': key[2], 'count': count}
+    for key, count in depth_counts.iteritems()])
+  for index in xrange(0, len(docs), 1000):
+    db.FollowOnPaths.insert(docs[index:index + 1000])
+  db.FollowOnPaths.ensure_index('initial_type')
+
+
+def update_follow_on_paths(db, removed_cases, added_cases):
+  """
+  Keep FollowOnPaths up to date when cases are rebuilt: subtract the old
+  versions of the cases (read with PATH_FIELDS) and add the new ones.
+  """
+  counts = count_paths(added_cases)
+  path_counts, depth_counts = count_paths(removed_cases, counts, -1)
+  for (initial_type, path), count in path_counts.iteritems():
+    if count:
+      db.FollowOnPaths.update({'initial_type': initial_type, 'path': list(path)}, {'$inc': {'count': count}}, upsert=True)
+  for (initial_type, depth, service_type), count in depth_counts.iteritems():
+    if count:
+      db.FollowOnPaths.update({'initial_type': initial_type, 'depth': depth, 'type': service_type}, {'$inc': {'count': count}}, upsert=True)
+  db.FollowOnPaths.remove({'count': {'$lte': 0}})
+
+
 def extract_type_tree(db, types):
   """
   Identify all request types that can result from a given set of initial request types.
   Unlike check_deepness, which identifies any type that *ever* result from a previous 
   type in the sequence, this only identifies types that belong to an *existing* 
   sequence of follow-ons starting with one of the initial types.
+  Reads from the FollowOnPaths collection (building it first if it's empty),
+  so following_types has how many cases had each type at each depth.
   db = A database connection to use
   types = A list of request type names (not codes) to start from
   """
+  if not db.FollowOnPaths.find_one():
+    build_follow_on_paths(db)
+  
+  followed_types = {}
+  following_types = []
+  result_trees = {}
+  request_count = 0
+  for row in db.FollowOnPaths.find({'initial_type': {'$in': types}}):
+    if 'path' in row:
+      request_count += row['count']
+      if len(row['path']) > 1:
+        followed_types[row['initial_type']] = True
+        tree_string = ' -> '.join(row['path'])
+        result_trees[tree_string] = result_trees.get(tree_string, 0) + row['count']
+    else:
+      while len(following_types) < row['depth']:
+        following_types.append({})
+      depth_types = following_types[row['depth'] - 1]
+      depth_types[row['type']] = depth_types.get(row['type'], 0) + row['count']
+  
+  return {
+    'request_count': request_count,
+    'followed_types': followed_types.keys(),
+    'following_types': following_types,
+    'follow_trees': result_trees,
+  }
+
+
+def query_type_tree(db, types):
+  """
+  extract_type_tree() the old way, straight from every matching case.
+  """
   followed_types = {}
   following_types = []
   result_trees = {}
@@ -89,15 +312,16 @@ def extract_type_tree(db, types):
   }
 
 
-def print_deepness(db, types, title=None, single_line=False):
+def print_deepness(db, types, title=None, single_line=False, graph=None):
   """
   Prettily prints the results of check_deepness.
   db = A database connection to use
   types = A list of request type names (not codes) to start from
   title = A title to print before the results
   single_line = If true, print each follow-on type on its own line (instead of a comma-separated list)
+  graph = A FollowOnGraph to answer from (see check_deepness)
   """
-  result = check_deepness(db, types)
+  result = check_deepness(db, types, graph=graph)
   if title:
     print '%s\n%s'% (title, len(title) * '=')
   else:
@@ -121,38 +345,113 @@ def print_deepness(db, types, title=None, single_line=False):
   print '\n\n'
 
 
-def print_type_tree(db, types, title=None, single_line=False, max_trees=25):
+def batch_type_trees(db, groups):
   """
-  Prettily prints the results of extract_type_tree.
+  extract_type_tree() for any number of groups of types in one pass over
+  the cases, adding each case to every group its initial type is in.
   db = A database connection to use
-  types = A list of request type names (not codes) to start from
-  title = A title to print before the results
-  single_line = If true, print each follow-on type on its own line (instead of a comma-separated list)
-  max_trees = List no more than this many possible request sequences
+  groups = {name: list of request type names} (e.g. from load_type_groups())
+  Returns {name: result}, with results like extract_type_tree()'s.
   """
-  result = extract_type_tree(db, types)
+  routes = {}
+  results = {}
+  for name, types in groups.iteritems():
+    results[name] = {'request_count': 0, 'followed_types': {}, 'following_types': [], 'follow_trees': {}}
+    for service_type in types:
+      routes.setdefault(service_type, []).append(results[name])
+  
+  for case in db.Cases.find({'initial_type': {'$in': routes.keys()}}, PATH_FIELDS):
+    path = case_path(case)
+    tree_string = len(path) > 1 and ' -> '.join(path) or None
+    for result in routes.get(path[0], []):
+      result['request_count'] += 1
+      if tree_string:
+        result['followed_types'][path[0]] = True
+        result['follow_trees'][tree_string] = result['follow_trees'].get(tree_string, 0) + 1
+        following_types = result['following_types']
+        for depth, service_type in enumerate(path[1:]):
+          if len(following_types) <= depth:
+            following_types.append({})
+          following_types[depth][service_type] = following_types[depth].get(service_type, 0) + 1
+  
+  for result in results.itervalues():
+    result['followed_types'] = result['followed_types'].keys()
+  return results
+
+
+def format_type_tree(result, types, title=None, single_line=False, max_trees=25):
+  """The lines print_type_tree() prints for a result from extract_type_tree()."""
+  lines = []
   if title:
-    print '%s\n%s'% (title, len(title) * '=')
+    lines.append('%s\n%s'% (title, len(title) * '='))
   else:
-    print '===================='
+    lines.append('====================')
     
-  print 'Types: %s (%s)' % (', '.join(types), result['request_count'])
+  lines.append('Types: %s (%s)' % (', '.join(types), result['request_count']))
   for depth, types in enumerate(result['following_types']):
     space = (depth + 1) * '  '
     line_start = '%sFollowed by: ' % space
     follow_join = single_line and ('\n%s' % (len(line_start) * ' ')) or ', '
-    print '%s%s' % (line_start, follow_join.join(types.keys()))
+    lines.append('%s%s' % (line_start, follow_join.join(types.keys())))
   
   tree_count = len(result['follow_trees'])
   if tree_count and max_trees:
-    print 'Possible paths:'
+    lines.append('Possible paths:')
     trees = sorted(result['follow_trees'].iteritems(), key=lambda x: x[1], reverse=True)
     for tree, count in trees[:max_trees]:
-      print '  (%s) %s' % (count, tree)
+      lines.append('  (%s) %s' % (count, tree))
     if tree_count > max_trees:
-      '...and %s more' % (tree_count - max_trees)
-    
-  print '\n\n'
+      lines.append('...and %s more' % (tree_count - max_trees))
+  
+  lines.append('\n\n')
+  return lines
+
+
+def print_type_tree(db, types, title=None, single_line=False, max_trees=25):
+  """
+  Prettily prints the results of extract_type_tree.
+  db = A database connection to use
+  types = A list of request type names (not codes) to start from
+  title = A title to print before the results
+  single_line = If true, print each follow-on type on its own line (instead of a comma-separated list)
+  max_trees = List no more than this many possible request sequences
+  """
+  result = extract_type_tree(db, types)
+  print '\n'.join(format_type_tree(result, types, title, single_line, max_trees))
+
+
+def load_type_groups(path):
+  """
+  Read named groups of types from a JSON file (see type_groups.json.example),
+  in order: {name: [types]} or {name: {"types": [types], "single_line": true}}.
+  Returns {name: types} and the set of names to print single_line.
+  """
+  config_file = open(path)
+  config = json.load(config_file, object_pairs_hook=OrderedDict)
+  config_file.close()
+  groups = OrderedDict()
+  single_line = set()
+  for name, group in config.iteritems():
+    if isinstance(group, dict):
+      groups[name] = group['types']
+      if group.get('single_line'):
+        single_line.add(name)
+    else:
+      groups[name] = group
+  return groups, single_line
+
+
+def print_batch_report(db, groups, single_line=(), max_trees=25, as_json=False):
+  """
+  Print type trees for all the groups ({name: types}) from one pass over the
+  cases (see batch_type_trees()), as text or as a JSON object.
+  """
+  results = batch_type_trees(db, groups)
+  if as_json:
+    print json.dumps(OrderedDict([(name, dict(results[name], types=types)) for name, types in groups.iteritems()]), indent=2)
+  else:
+    for name, types in groups.iteritems():
+      print '\n'.join(format_type_tree(results[name], types, name, name in single_line, max_trees))
 
 
 types_animal = ["Vicious Animal",
@@ -186,28 +485,48 @@ types_traffic_lights = ["Traffic Light Out","Red Light Camera","Traffic Light St
 types_building = ["Building Violation","No Building Permit & Construction Violations","Building - Illegal Conversion",]
 
 
+# The groups reported on by default, in order; SEWER and BUILDING types
+# have long names, so they're printed one per line
+TYPE_GROUPS = OrderedDict([
+  ('ANIMALS', types_animal),
+  ('RODENTS', types_rodent),
+  ('TREES', types_trees),
+  ('GRAFFITI', types_graffiti),
+  ('DUMPING', types_dumping),
+  ('STREET LIGHTS', types_street_lights),
+  ('TRAFFIC LIGHTS', types_traffic_lights),
+  ('SEWER', types_sewer),
+  ('BUILDING', types_building),
+])
+SINGLE_LINE_GROUPS = set(['SEWER', 'BUILDING'])
+
+
 if __name__ == '__main__':
+  parser = OptionParser()
+  parser.add_option('-g', '--groups', dest='groups', help='A JSON file of named type groups to report on (see type_groups.json.example; default TYPE_GROUPS)')
+  parser.add_option('--json', action='store_true', dest='json', default=False, help='Print the reports as JSON')
+  parser.add_option('--maxtrees', type='int', dest='max_trees', default=25, help='List no more than this many paths per group')
+  (options, args) = parser.parse_args()
+  
   connection = pymongo.Connection(DB_HOST, DB_PORT)
   db = connection[DB_NAME]
   
-  # Identify broad type connections
-  # print_deepness(db, types_animal, 'ANIMALS')
-  # print_deepness(db, types_rodent, 'RODENTS')
-  # print_deepness(db, types_trees, 'TREES')
-  # print_deepness(db, types_graffiti, 'GRAFFITI')
-  # print_deepness(db, types_dumping, 'DUMPING')
-  # print_deepness(db, types_street_lights, 'STREET LIGHTS')
-  # print_deepness(db, types_traffic_lights, 'TRAFFIC LIGHTS')
-  # print_deepness(db, types_sewer, 'SEWER', True)
-  # print_deepness(db, types_building, 'BUILDING', True)
-  
-  # Keep it to explicit trees of requests that have actually been seen
-  print_type_tree(db, types_animal, 'ANIMALS')
-  print_type_tree(db, types_rodent, 'RODENTS')
-  print_type_tree(db, types_trees, 'TREES')
-  print_type_tree(db, types_graffiti, 'GRAFFITI')
-  print_type_tree(db, types_dumping, 'DUMPING')
-  print_type_tree(db, types_street_lights, 'STREET LIGHTS')
-  print_type_tree(db, types_traffic_lights, 'TRAFFIC LIGHTS')
-  print_type_tree(db, types_sewer, 'SEWER', True)
-  print_type_tree(db, types_building, 'BUILDING', True)
+  # Identify broad type connections (from the follow-on graph, cached in GRAPH_CACHE)
+  # graph = load_follow_on_graph(db)
+  # print_deepness(db, types_animal, 'ANIMALS', graph=graph)
+  # print_deepness(db, types_rodent, 'RODENTS', graph=graph)
+  # print_deepness(db, types_trees, 'TREES', graph=graph)
+  # print_deepness(db, types_graffiti, 'GRAFFITI', graph=graph)
+  # print_deepness(db, types_dumping, 'DUMPING', graph=graph)
+  # print_deepness(db, types_street_lights, 'STREET LIGHTS', graph=graph)
+  # print_deepness(db, types_traffic_lights, 'TRAFFIC LIGHTS', graph=graph)
+  # print_deepness(db, types_sewer, 'SEWER', True, graph=graph)
+  # print_deepness(db, types_building, 'BUILDING', True, graph=graph)
+  
+  # Keep it to explicit trees of requests that have actually been seen,
+  # for every group in one pass over the cases
+  if options.groups:
+    groups, single_line = load_type_groups(options.groups)
+  else:
+    groups, single_line = TYPE_GROUPS, SINGLE_LINE_GROUPS
+  print_batch_report(db, groups, single_line, options.max_trees, options.json)
@@ -0,0 +1,68 @@
+"""
+Helpers for finding requests, combined requests or cases by area, using the
+GeoJSON points the transformer stores in 'location' (and the 2dsphere
+indexes it creates on them).
+
+  import chicago311transformer as transformer, geo_queries
+  db = transformer.connect_db()
+  cases = geo_queries.within_radius(db.Cases, 41.8781, -87.6298, 500)
+
+Distances are in meters.
+"""
+
+# Mean radius of the earth, for turning distances into radians
+EARTH_RADIUS_METERS = 6371000.0
+
+
+def radius_spec(latitude, longitude, radius, spec=None):
+  """A query for documents within radius meters of a point."""
+  spec = dict(spec or {})
+  spec['location'] = {'$geoWithin': {'$centerSphere': [[longitude, latitude], radius / EARTH_RADIUS_METERS]}}
+  return spec
+
+
+def box_spec(south, west, north, east, spec=None):
+  """
+  A query for documents within a bounding box. The box's edges are
+  geodesics, not lines of latitude, but over an area the size of Chicago
+  the difference is a few meters at most.
+  """
+  spec = dict(spec or {})
+  corners = [[west, south], [east, south], [east, north], [west, north], [west, south]]
+  spec['location'] = {'$geoWithin': {'$geometry': {'type': 'Polygon', 'coordinates': [corners]}}}
+  return spec
+
+
+def within_radius(collection, latitude, longitude, radius, spec=None, fields=None):
+  return collection.find(radius_spec(latitude, longitude, radius, spec), fields)
+
+
+def within_box(collection, south, west, north, east, spec=None, fields=None):
+  return collection.find(box_spec(south, west, north, east, spec), fields)
+
+
+def nearest(collection, latitude, longitude, max_distance=None, spec=None, fields=None, limit=100):
+  """The documents closest to a point (within max_distance, if given), closest first."""
+  near = {'$geometry': {'type': 'Point', 'coordinates': [longitude, latitude]}}
+  if max_distance is not None:
+    near['$maxDistance'] = max_distance
+  spec = dict(spec or {})
+  spec['location'] = {'$nearSphere': near}
+  return collection.find(spec, fields).limit(limit)
+
+
+def query_plan(cursor):
+  """
+  Which plan a query uses and how many documents it examines, as
+  (plan, documents examined), from either the old (before Mongo 3.0) or new
+  format of explain().
+  """
+  explanation = cursor.explain()
+  if 'cursor' in explanation:
+    return explanation['cursor'], explanation.get('nscannedObjects')
+  stages = []
+  stage = explanation['queryPlanner']['winningPlan']
+  while stage:
+    stages.append(stage['stage'])
+    stage = stage.get('inputStage')
+  return ' > '.join(stages), explanation.get('executionStats', {}).get('totalDocsExamined')
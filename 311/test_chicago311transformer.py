@@ -0,0 +1,114 @@
+"""
+Tests for the parts of chicago311transformer.py that don't need Mongo.
+
+python -m unittest test_chicago311transformer
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+import chicago311transformer as transformer
+import benchmark_formats
+import benchmark_mapper
+
+
+def combined_request(number, **fields):
+  request = {
+    'service_request_number': number,
+    'service_request_type': 'Tree Trim',
+    'status': 'open',
+    'created': datetime(2012, 1, 1),
+    'updated': datetime(2012, 1, 2),
+    'follow_on_service_request': None,
+    'address': '121 N LA SALLE ST',
+    'latitude': 41.88,
+    'longitude': -87.63,
+    'location': {'type': 'Point', 'coordinates': [-87.63, 41.88]},
+    'x_coordinate': 1174000.0,
+    'y_coordinate': 1901000.0,
+    'zip': '60602',
+  }
+  request.update(fields)
+  return request
+
+
+class MakeCaseTest(unittest.TestCase):
+  def test_completed_without_completion_date(self):
+    request = combined_request('12-00000001', status='completed')
+    case = transformer.make_case([request])
+    self.assertEqual(case['status'], 'completed')
+    self.assertEqual(case['completed'], None)
+
+  def test_completed(self):
+    request = combined_request('12-00000001', status='completed', completed=datetime(2012, 1, 3))
+    case = transformer.make_case([request])
+    self.assertEqual(case['completed'], datetime(2012, 1, 3))
+
+
+class SplitExportTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.columns = benchmark_mapper.synthetic_columns()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def export(self, name, rows, **dump_options):
+    path = os.path.join(self.directory, name)
+    thefile = open(path, 'w')
+    json.dump({'meta': {'view': {'columns': self.columns}}, 'data': rows}, thefile, **dump_options)
+    thefile.close()
+    return path
+
+  def test_one_row_per_line(self):
+    rows = list(benchmark_mapper.synthetic_rows(100))
+    path = os.path.join(self.directory, 'rows.json')
+    benchmark_formats.write_export(path, self.columns, rows)
+    columns, boundaries = transformer.split_export(path, 2)
+    self.assertEqual(columns, self.columns)
+    thefile = open(path, 'rb')
+    read = []
+    for index in xrange(len(boundaries) - 1):
+      read.extend([row for offset, row in transformer.read_row_lines(thefile, boundaries[index], boundaries[index + 1])])
+    thefile.close()
+    self.assertEqual(read, json.loads(json.dumps(rows)))
+
+  def test_pretty_printed(self):
+    path = self.export('pretty.json', list(benchmark_mapper.synthetic_rows(10)), indent=2)
+    self.assertEqual(transformer.split_export(path, 2), None)
+
+  def test_minified(self):
+    path = self.export('minified.json', list(benchmark_mapper.synthetic_rows(10)), separators=(',', ':'))
+    self.assertEqual(transformer.split_export(path, 2), None)
+
+
+class CSVExportTest(unittest.TestCase):
+  def test_blank_cells(self):
+    columns = benchmark_mapper.synthetic_columns()
+    rows = list(benchmark_mapper.synthetic_rows(3))
+    names = [column['name'] for column in columns]
+    rows[1][names.index('status')] = None
+    rows[1][names.index('follow_on_service_request')] = None
+    directory = tempfile.mkdtemp()
+    try:
+      path = os.path.join(directory, 'blank.csv')
+      benchmark_formats.write_export(path, columns, rows)
+      thefile, export_format = transformer.open_export(path)
+      csv_columns, csv_rows = transformer.read_export(thefile, export_format)
+      csv_rows = list(csv_rows)
+      thefile.close()
+    finally:
+      shutil.rmtree(directory)
+    
+    mapper = transformer.make_sr_mapper(csv_columns)
+    doc = mapper(csv_rows[1])
+    self.assertEqual(doc['status'], '')
+    self.assertEqual(doc['follow_on_service_request'], None)
+    self.assertEqual(mapper(csv_rows[0])['status'], rows[0][names.index('status')].lower())
+
+
+if __name__ == '__main__':
+  unittest.main()
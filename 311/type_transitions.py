@@ -0,0 +1,223 @@
+"""
+Treats follow-ons as a Markov chain over request types: counts how often each
+type is followed by each other type in Cases, in a NumPy matrix, and answers
+questions about follow-ons with matrix operations instead of queries.
+
+The matrix has a row and column for every type plus two extra states: START
+(row 0), whose row counts the cases each type starts, and END (the last
+column), which counts the cases each type ends. It's saved as a .npy file,
+with the type names alongside it as JSON.
+
+python type_transitions.py --build
+python type_transitions.py --group types_trees --depth 4
+"""
+
+import json
+import numpy
+import pymongo
+from optparse import OptionParser
+import explore_types
+
+DB_HOST = explore_types.DB_HOST
+DB_PORT = explore_types.DB_PORT
+DB_NAME = explore_types.DB_NAME
+
+# Where save_transitions() and load_transitions() keep the matrix
+MATRIX_FILE = 'type_transitions.npy'
+
+
+class TypeTransitions(object):
+  """
+  Transition counts between request types. types[i] is the type of row and
+  column i + 1; row 0 is START and the last column is END.
+  """
+  def __init__(self, types, counts):
+    self.types = types
+    self.counts = counts
+    self.codes = dict([(name, index + 1) for index, name in enumerate(types)])
+    self.end = len(types) + 1
+
+  def encode(self, types):
+    """The state numbers of the given types (skipping ones never seen)."""
+    return numpy.array([self.codes[name] for name in types if name in self.codes], dtype=numpy.intp)
+
+  def probabilities(self):
+    """Row-normalized counts: the chance of each state following each state."""
+    totals = self.counts.sum(axis=1).astype(numpy.float64)
+    totals[totals == 0] = 1
+    return self.counts / totals[:, numpy.newaxis]
+
+  def start_vector(self, types):
+    """How many cases start with each of the given types, as a state vector."""
+    vector = numpy.zeros(self.end + 1)
+    codes = self.encode(types)
+    vector[codes] = self.counts[0, codes]
+    return vector
+
+  def deepness(self, types):
+    """
+    Like explore_types.check_deepness(), a list of the new types that can
+    follow at each level, starting from the given types and leaving out
+    types already seen, until there aren't any more.
+    """
+    links = self.counts[1:self.end, 1:self.end] > 0
+    current = numpy.zeros(len(self.types), dtype=bool)
+    current[self.encode(types) - 1] = True
+    seen = current.copy()
+    levels = []
+    while current.any():
+      following = links[current].any(axis=0)
+      levels.append([self.types[index] for index in numpy.flatnonzero(following)])
+      current = following & ~seen
+      seen |= following
+    return levels
+
+  def reachable(self, types):
+    """Every type that can follow the given types, directly or not."""
+    reached = set()
+    for level in self.deepness(types):
+      reached.update(level)
+    return sorted(reached)
+
+  def depth_distributions(self, types, depth):
+    """
+    The chance of a case that starts with one of the given types having
+    each type (or having ended, under 'END') at each depth up to depth, as
+    a list of {type: probability}. Assumes the next type only depends on
+    the current one (not on how the case got there), so these are
+    estimates; the FollowOnPaths counts in explore_types.py are exact.
+    """
+    probabilities = self.probabilities()
+    # cases that ended stay ended
+    probabilities[self.end, self.end] = 1
+    vector = self.start_vector(types)
+    vector = vector / (vector.sum() or 1)
+    distributions = []
+    for level in xrange(depth):
+      vector = vector.dot(probabilities)
+      distribution = dict([(self.types[index - 1], vector[index]) for index in numpy.flatnonzero(vector[1:self.end]) + 1])
+      distribution['END'] = vector[self.end]
+      distributions.append(distribution)
+    return distributions
+
+  def likely_paths(self, types, max_depth=5, count=10):
+    """
+    The count most likely sequences of follow-ons for cases starting with
+    the given types, as (probability, [types]), found with a beam search.
+    Paths that end before max_depth are included as they end.
+    """
+    with numpy.errstate(divide='ignore'):
+      log_probabilities = numpy.log(self.probabilities())
+      start = self.start_vector(types)
+      scores = numpy.log(start / (start.sum() or 1))
+    paths = [[code] for code in numpy.flatnonzero(numpy.isfinite(scores))]
+    scores = scores[numpy.isfinite(scores)]
+    finished = []
+    for level in xrange(max_depth):
+      if not paths:
+        break
+      # score every path followed by every state, then keep the best
+      candidates = scores[:, numpy.newaxis] + log_probabilities[[path[-1] for path in paths]]
+      flat = candidates.ravel()
+      keep = min(count, numpy.isfinite(flat).sum())
+      best = numpy.argpartition(-flat, keep - 1)[:keep] if keep else []
+      next_paths = []
+      next_scores = []
+      for index in best:
+        path_index, state = divmod(index, self.end + 1)
+        if state == self.end:
+          finished.append((flat[index], paths[path_index]))
+        else:
+          next_paths.append(paths[path_index] + [state])
+          next_scores.append(flat[index])
+      paths = next_paths
+      scores = numpy.array(next_scores)
+    finished.extend(zip(scores, paths))
+    finished.sort(key=lambda item: item[0], reverse=True)
+    return [(numpy.exp(score), [self.types[state - 1] for state in path]) for score, path in finished[:count]]
+
+
+def build_transitions(db):
+  """
+  Count transitions from one pass over the cases. Each case's types are
+  encoded as they're read, then all the transitions are counted at once.
+  """
+  codes = {}
+  types = []
+  states = []
+  for case in db.Cases.find({}, explore_types.PATH_FIELDS):
+    states.append(0)
+    for name in explore_types.case_path(case):
+      code = codes.get(name)
+      if code is None:
+        code = codes[name] = len(types) + 1
+        types.append(name)
+      states.append(code)
+
+  # each case is START, its types, then the START of the next case, which
+  # stands for END; shift those to the END column
+  end = len(types) + 1
+  states.append(0)
+  states = numpy.array(states, dtype=numpy.intp)
+  sources = states[:-1]
+  targets = states[1:].copy()
+  targets[targets == 0] = end
+  counts = numpy.bincount(sources * (end + 1) + targets, minlength=(end + 1) ** 2)
+  return TypeTransitions(types, counts.reshape((end + 1, end + 1)))
+
+
+def save_transitions(transitions, path=MATRIX_FILE):
+  numpy.save(path, transitions.counts)
+  names_file = open(names_path(path), 'w')
+  json.dump(transitions.types, names_file)
+  names_file.close()
+
+
+def load_transitions(path=MATRIX_FILE):
+  names_file = open(names_path(path))
+  types = json.load(names_file)
+  names_file.close()
+  return TypeTransitions(types, numpy.load(path))
+
+
+def names_path(path):
+  return path.rsplit('.npy', 1)[0] + '.json'
+
+
+def print_transitions(transitions, types, title=None, depth=3, max_paths=10):
+  """Prettily prints depth distributions and likely paths for a set of initial types."""
+  if title:
+    print '%s\n%s'% (title, len(title) * '=')
+  else:
+    print '===================='
+
+  print 'Types: %s (%s cases)' % (', '.join(types), int(transitions.start_vector(types).sum()))
+  for level, distribution in enumerate(transitions.depth_distributions(types, depth)):
+    ranked = sorted(distribution.iteritems(), key=lambda item: item[1], reverse=True)
+    print '%sDepth %s: %s' % ((level + 1) * '  ', level + 1, ', '.join(['%s (%.1f%%)' % (name, chance * 100) for name, chance in ranked[:8]]))
+  print 'Eventually followed by: %s' % ', '.join(transitions.reachable(types))
+  print 'Most likely paths:'
+  for chance, path in transitions.likely_paths(types, depth, max_paths):
+    print '  (%.2f%%) %s' % (chance * 100, ' -> '.join(path))
+  print '\n\n'
+
+
+if __name__ == '__main__':
+  parser = OptionParser()
+  parser.add_option('--build', action='store_true', dest='build', help='Rebuild the matrix from Cases (otherwise it is loaded from --file)')
+  parser.add_option('-f', '--file', dest='file', default=MATRIX_FILE, help='Where the matrix is saved (default %s)' % MATRIX_FILE)
+  parser.add_option('-g', '--group', dest='groups', action='append', help='A type group from explore_types.py to report on (default all of them)')
+  parser.add_option('-d', '--depth', type='int', dest='depth', default=3, help='How many follow-ons deep to report')
+  (options, args) = parser.parse_args()
+
+  if options.build:
+    connection = pymongo.Connection(DB_HOST, DB_PORT)
+    transitions = build_transitions(connection[DB_NAME])
+    save_transitions(transitions, options.file)
+    print 'Saved transitions between %s types to %s' % (len(transitions.types), options.file)
+  else:
+    transitions = load_transitions(options.file)
+
+  groups = options.groups or sorted([name for name in dir(explore_types) if name.startswith('types_')])
+  for name in groups:
+    print_transitions(transitions, getattr(explore_types, name), name[len('types_'):].replace('_', ' ').upper(), options.depth)
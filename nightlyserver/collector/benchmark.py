@@ -0,0 +1,171 @@
+"""
+Benchmark the collector's stages (fetch, clean_results, projection, encode
+and upload) against a synthetic SQLite stand-in of the reporting database and
+a local stub /receive endpoint, so it can be profiled on any machine.
+
+Reports rows/sec and peak RSS after each stage:
+
+    python benchmark.py --srs 50000 --activities 8
+    python benchmark.py --srs 50000 --split --json >> bench_history.json
+
+Peak RSS is the process's high-water mark, so it only grows from stage to
+stage; the increase shows what each stage added.
+"""
+
+import BaseHTTPServer
+import datetime
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from optparse import OptionParser
+import pyproj
+import collector
+import sqlite_standin
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+# Illinois East State Plane (feet), which the reporting database uses
+DEFAULT_PROJECTION = '+proj=tmerc +lat_0=36.66666666666666 +lon_0=-88.33333333333333 +k=0.9999749999999999 +x_0=300000.0000000001 +y_0=0 +ellps=GRS80 +towgs84=0,0,0,0,0,0,0 +units=us-ft +no_defs'
+
+
+class StubReceiveHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Accepts POSTs to /receive, optionally with a delay, and discards them."""
+    latency = 0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        if self.latency:
+            time.sleep(self.latency)
+        self.send_response(self.path.startswith('/receive') and 200 or 404)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stub_server(latency=0):
+    StubReceiveHandler.latency = latency
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StubReceiveHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%s/' % server.server_port
+
+
+@contextmanager
+def quiet_timer(message=''):
+    yield None
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on OS X
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak = peak / 1024
+    return peak / 1024.0
+
+
+class StageTimer(object):
+    def __init__(self):
+        self.stages = []
+
+    def run(self, name, rows, function, *args):
+        start = time.time()
+        result = function(*args)
+        elapsed = time.time() - start
+        row_count = rows(result)
+        self.stages.append({
+            'stage': name,
+            'rows': row_count,
+            'seconds': elapsed,
+            'rows_per_sec': elapsed and row_count / elapsed or None,
+            'peak_rss_mb': peak_rss_mb(),
+        })
+        return result
+
+    def report(self):
+        print '%-10s %10s %10s %12s %14s' % ('Stage', 'Rows', 'Seconds', 'Rows/sec', 'Peak RSS (MB)')
+        for stage in self.stages:
+            print '%-10s %10s %10.3f %12.0f %14.1f' % (
+                stage['stage'], stage['rows'], stage['seconds'], stage['rows_per_sec'] or 0, stage['peak_rss_mb'])
+
+
+def fetch(the_date, split):
+    if split:
+        codes = collector.get_code_descriptions()
+        return collector.get_split_for_dates(the_date) + (codes,)
+    return collector.get_for_dates(the_date)
+
+
+def clean(results, split):
+    if split:
+        return collector.merge_results(*results)
+    return collector.clean_results(results)
+
+
+def project(srs, projector):
+    collector.projector = projector
+    for sr in srs:
+        collector.project_sr(sr)
+    collector.projector = None
+    return srs
+
+
+def encode(srs):
+    return list(collector.encode_chunks(srs))
+
+
+def upload(chunks, send_url):
+    for index, chunk in enumerate(chunks):
+        collector.post_chunk(send_url, {}, chunk, index + 1)
+    return chunks
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("-n", "--srs", dest="srs", default=10000, type="int", help="Number of synthetic SRs")
+    parser.add_option("-a", "--activities", dest="activities", default=8, type="int", help="Average number of activities per SR")
+    parser.add_option("--split", dest="split", action="store_true", help="Benchmark the split extraction mode instead of the join", default=False)
+    parser.add_option("--projection", dest="projection", default=DEFAULT_PROJECTION, help="Proj.4 string for the projection stage")
+    parser.add_option("--latency", dest="latency", default=0, type="float", help="Seconds the stub /receive endpoint waits before responding")
+    parser.add_option("--db", dest="db", default=':memory:', help="SQLite file to build the stand-in in (must not exist)")
+    parser.add_option("--json", dest="json", action="store_true", help="Print results as a line of JSON", default=False)
+    (options, args) = parser.parse_args()
+
+    the_date = datetime.datetime(2012, 1, 1)
+    collector.connect_db(sqlite_standin.build(options.db, sr_count=options.srs,
+        activities_per_sr=options.activities, start_date=the_date))
+    # clean_results() normally projects inline; it gets its own stage here
+    collector.projector = None
+    projector = pyproj.Proj(options.projection, preserve_units=True)
+    server, send_url = start_stub_server(options.latency)
+    # don't print a timing line for every uploaded chunk
+    collector.debug_timer = quiet_timer
+
+    timer = StageTimer()
+    if options.split:
+        results = timer.run('fetch', lambda result: len(result[0]) + len(result[1]), fetch, the_date, True)
+    else:
+        results = timer.run('fetch', len, fetch, the_date, False)
+    data = timer.run('clean', len, clean, results, options.split)
+    del results
+    srs = timer.run('project', len, project, data.values(), projector)
+    chunks = timer.run('encode', lambda chunks: len(srs), encode, srs)
+    timer.run('upload', lambda chunks: len(srs), upload, chunks, send_url + 'receive')
+    server.shutdown()
+
+    if options.json:
+        print json.dumps({
+            'date': datetime.datetime.now().isoformat(),
+            'srs': options.srs,
+            'activities': options.activities,
+            'split': options.split,
+            'stages': timer.stages,
+        })
+    else:
+        timer.report()
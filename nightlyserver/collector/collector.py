@@ -5,21 +5,36 @@ except ImportError:
     import simplejson as json
     
 import datetime
+import glob
+import gzip
+import os
 from optparse import OptionParser
 import sys
 import time
 from math import ceil
 from contextlib import contextmanager
-import cx_Oracle
 import pyproj
 import requests
-from collector_config import *
+try:
+    from collector_config import *
+    HAVE_CONFIG = True
+except ImportError:
+    # Without a config the collector can still run against a connection passed
+    # to connect_db() and an explicit send URL (see benchmark.py).
+    HAVE_CONFIG = False
+    PROJECTION = None
+    DEFAULT_SEND_URL = ''
+    OPEN311_API_KEY = ''
 
 SEND_CHUNK_SIZE = 200
 SEND_CHUNK_PAUSE = 0 # seconds
 SEND_CHUNK_RETRY_PAUSE = 20 # seconds
 SEND_CHUNK_RETRIES = 3
 
+# Saved output files that --replay will send, and where it records progress
+REPLAY_PATTERNS = ('nightlydata_*.json', 'nightlydata_*.json.gz', 'nightlydata_*.ndjson', 'nightlydata_*.ndjson.gz')
+REPLAY_CHECKPOINT = 'replay_checkpoint.json'
+
 SR_FIELDS = (
     "EID",
     "SERVICE_REQUEST_NUM",
@@ -99,14 +114,103 @@ projector = None
 if PROJECTION:
     projector = pyproj.Proj(PROJECTION, preserve_units=True)
 
-dsn = cx_Oracle.makedsn(DB_PATH, DB_PORT, DB_NAME)
-db = cx_Oracle.connect(DB_USER, DB_PASS, dsn)
+# SR fields for the split extraction mode (no joined code descriptions)
+SPLIT_SR_FIELD_NAMES = map(lambda x: 'srs.' + x, SR_FIELDS)
+
+# activity fields for the split extraction mode (no joined code descriptions)
+SPLIT_ACTIVITY_FIELD_NAMES = map(lambda x: 'act.' + x, ACTIVITY_FIELDS)
+
+# code description types used when merging split results
+GROUP_CODE_TYPE = 'GROUP'
+ACTIVITY_CODE_TYPE = 'SRACTVTY'
+
+# The date window shared by all the SR queries
+DATE_WINDOW = "srs.UPDATED_DATE >= :start_date AND srs.UPDATED_DATE < :end_date"
+
+JOIN_QUERY = """SELECT %s 
+    FROM SERVICE_REQUESTS srs 
+        LEFT JOIN SR_ACTIVITIES act 
+            ON srs.EID = act.SERVICE_REQUEST_EID
+        LEFT JOIN CODE_DESCRIPTIONS codes_group
+            ON srs.GROUP_CODE = codes_group.CODE_CODE AND codes_group.TYPE_CODE = '%s'
+        LEFT JOIN CODE_DESCRIPTIONS codes_act
+            ON act.ACTIVITY_CODE = codes_act.CODE_CODE AND codes_act.TYPE_CODE = '%s'
+    WHERE %s""" % (', '.join(FIELD_NAMES), GROUP_CODE_TYPE, ACTIVITY_CODE_TYPE, DATE_WINDOW)
+
+SPLIT_SR_QUERY = """SELECT %s
+    FROM SERVICE_REQUESTS srs
+    WHERE %s""" % (', '.join(SPLIT_SR_FIELD_NAMES), DATE_WINDOW)
+
+SPLIT_ACTIVITY_QUERY = """SELECT %s
+    FROM SR_ACTIVITIES act
+    WHERE act.SERVICE_REQUEST_EID IN (
+        SELECT srs.EID FROM SERVICE_REQUESTS srs WHERE %s)""" % (', '.join(SPLIT_ACTIVITY_FIELD_NAMES), DATE_WINDOW)
+
+CODE_DESCRIPTIONS_QUERY = """SELECT TYPE_CODE, CODE_CODE, DESCRIPTION
+    FROM CODE_DESCRIPTIONS
+    WHERE TYPE_CODE IN ('%s', '%s')""" % (GROUP_CODE_TYPE, ACTIVITY_CODE_TYPE)
+
+SERVICE_TYPES_QUERY = "SELECT CODE_CODE, DESCRIPTION FROM CODE_DESCRIPTIONS WHERE TYPE_CODE = 'SRSRTYPE'"
+
+# Every query the collector runs. Each is prepared once per connection (see
+# execute()) so Oracle can reuse a single cached plan for every date window.
+QUERIES = {
+    'join': JOIN_QUERY,
+    'split_srs': SPLIT_SR_QUERY,
+    'split_activities': SPLIT_ACTIVITY_QUERY,
+    'code_descriptions': CODE_DESCRIPTIONS_QUERY,
+    'service_types': SERVICE_TYPES_QUERY,
+}
+
+db = None
+
+# {query name: cursor with that query prepared}, reset by connect_db()
+prepared = {}
+
+# {(TYPE_CODE, CODE_CODE): DESCRIPTION}, loaded once by get_code_descriptions()
+code_descriptions = None
+
+def connect_db(connection=None):
+    """
+    Connect to the reporting database. Pass an existing DB-API connection
+    (e.g. a local stand-in) to use it instead of connecting to Oracle.
+    """
+    global db, prepared, code_descriptions
+    if connection is None:
+        if not HAVE_CONFIG:
+            raise Exception('No collector_config.py; copy collector_config.py.example and fill it in.')
+        import cx_Oracle
+        dsn = cx_Oracle.makedsn(DB_PATH, DB_PORT, DB_NAME)
+        connection = cx_Oracle.connect(DB_USER, DB_PASS, dsn)
+    db = connection
+    prepared = {}
+    code_descriptions = None
+    return db
+
+
+def execute(name, params=None):
+    """
+    Run one of the QUERIES with the given bind parameters and return its
+    cursor. Each query gets its own cursor and is prepared the first time it's
+    used on a connection; later calls only rebind the parameters.
+    """
+    cursor = prepared.get(name)
+    if cursor is None:
+        cursor = db.cursor()
+        if hasattr(cursor, 'prepare'):
+            cursor.prepare(QUERIES[name])
+        prepared[name] = cursor
+    
+    if hasattr(cursor, 'prepare'):
+        # cx_Oracle: None means "the prepared statement"
+        cursor.execute(None, params or {})
+    else:
+        cursor.execute(QUERIES[name], params or {})
+    return cursor
 
-cur = db.cursor()
 
 def get_service_types():
-    cur.execute("SELECT CODE_CODE, DESCRIPTION FROM CODE_DESCRIPTIONS WHERE TYPE_CODE = 'SRSRTYPE'")
-    results = cur.fetchall()
+    results = execute('service_types').fetchall()
     types = {}
     for item in results:
         types[item[0]] = item[1]
@@ -114,25 +218,61 @@ def get_service_types():
     return types
 
 
-def get_for_dates(start_date, end_date=None):
-    # clean up dates
-    start_day = start_date.strftime('%d-%b-%y')
+def as_datetime(value):
+    if not isinstance(value, datetime.datetime):
+        value = datetime.datetime.combine(value, datetime.time())
+    return value
+
+
+def date_window(start_date, end_date=None):
+    """
+    Bind parameters for the [start_date, end_date) window. Dates are bound as
+    real datetimes (midnight for plain dates), so windows can be any length
+    and don't depend on the session's date format. Defaults to one day.
+    """
+    start_date = as_datetime(start_date)
     if not end_date:
         end_date = start_date + datetime.timedelta(1)
-    end_day = end_date.strftime('%d-%b-%y')
-    
-    # do the query
-    cur.execute("""SELECT %s 
-        FROM SERVICE_REQUESTS srs 
-            LEFT JOIN SR_ACTIVITIES act 
-                ON srs.EID = act.SERVICE_REQUEST_EID
-            LEFT JOIN CODE_DESCRIPTIONS codes_group
-                ON srs.GROUP_CODE = codes_group.CODE_CODE AND codes_group.TYPE_CODE = 'GROUP'
-            LEFT JOIN CODE_DESCRIPTIONS codes_act
-                ON act.ACTIVITY_CODE = codes_act.CODE_CODE AND codes_act.TYPE_CODE = 'SRACTVTY'
-        WHERE srs.UPDATED_DATE >= '%s' AND srs.UPDATED_DATE < '%s'""" % (', '.join(FIELD_NAMES), start_day, end_day))
-    
-    return cur.fetchall()
+    return {'start_date': start_date, 'end_date': as_datetime(end_date)}
+
+
+def get_for_dates(start_date, end_date=None):
+    return execute('join', date_window(start_date, end_date)).fetchall()
+
+
+def get_code_descriptions():
+    """
+    Load the group and activity code descriptions into memory. They are only
+    queried once per connection.
+    """
+    global code_descriptions
+    if code_descriptions is None:
+        code_descriptions = {}
+        for type_code, code, description in execute('code_descriptions').fetchall():
+            code_descriptions[(type_code, code)] = description
+    return code_descriptions
+
+
+def get_split_for_dates(start_date, end_date=None):
+    """
+    Alternative to get_for_dates() that gets SRs and their activities with
+    separate queries instead of one big join, so the SR columns aren't
+    repeated for every activity. Returns (sr_rows, activity_rows).
+    """
+    params = date_window(start_date, end_date)
+    sr_rows = execute('split_srs', params).fetchall()
+    activity_rows = execute('split_activities', params).fetchall()
+    return sr_rows, activity_rows
+
+
+def project_sr(sr):
+    if projector:
+        x = sr['srs.X_COORDINATE']
+        y = sr['srs.Y_COORDINATE']
+        if x and y:
+            longitude, latitude = projector(x, y, inverse=True)
+            sr['srs.X_COORDINATE'] = longitude
+            sr['srs.Y_COORDINATE'] = latitude
 
 
 def clean_results(results):
@@ -148,13 +288,7 @@ def clean_results(results):
                 sr[field_name] = row[index]
             # for index, value in enumerate(row):
             #     sr[FIELD_NAMES[index]] = value
-            if projector:
-                x = sr['srs.X_COORDINATE']
-                y = sr['srs.Y_COORDINATE']
-                if x and y:
-                    longitude, latitude = projector(x, y, inverse=True)
-                    sr['srs.X_COORDINATE'] = longitude
-                    sr['srs.Y_COORDINATE'] = latitude
+            project_sr(sr)
         
         # if there are no activities, act.EID (the first activity field) will be None
         activity_index = len(SR_FIELD_NAMES)
@@ -168,6 +302,40 @@ def clean_results(results):
     return srs
 
 
+def merge_results(sr_rows, activity_rows, codes):
+    """
+    Merge the results of get_split_for_dates() into the same structure
+    clean_results() produces for the join query.
+    """
+    srs = {}
+    srs_by_eid = {}
+    for row in sr_rows:
+        if row[1] in srs:
+            # like clean_results(), a repeated SR number keeps the first
+            # SR's fields but gets the repeat's activities too
+            srs_by_eid[row[0]] = srs[row[1]]
+            continue
+        sr = {'activities': []}
+        for index, field_name in enumerate(SPLIT_SR_FIELD_NAMES):
+            sr[field_name] = row[index]
+        sr['codes_group.DESCRIPTION'] = codes.get((GROUP_CODE_TYPE, sr['srs.GROUP_CODE']))
+        project_sr(sr)
+        srs[row[1]] = sr
+        srs_by_eid[sr['srs.EID']] = sr
+    
+    for row in activity_rows:
+        sr = srs_by_eid.get(row[1])
+        if not sr:
+            continue
+        activity = {}
+        for index, field_name in enumerate(SPLIT_ACTIVITY_FIELD_NAMES):
+            activity[field_name] = row[index]
+        activity['codes_act.DESCRIPTION'] = codes.get((ACTIVITY_CODE_TYPE, activity['act.ACTIVITY_CODE']))
+        sr['activities'].append(activity)
+    
+    return srs
+
+
 def sr_json_encoder(obj):
     # Dates will have "date::" in front so they are easy to identify
     if isinstance(obj, datetime.datetime):
@@ -185,31 +353,54 @@ def debug_timer(message=''):
 
 
 ############### API YOU WANT TO USE #################
-def do_date_range(start, end=None, save=False, send=True, api_key=None):
+def do_date_range(start, end=None, save=False, send=True, api_key=None, split=False, window=None):
+    """
+    Collect [start, end) in consecutive windows (a timedelta; one day by default).
+    """
+    start = as_datetime(start)
+    window = window or datetime.timedelta(1)
     if not end:
-        end = start + datetime.timedelta(1)
+        end = start + window
+    end = as_datetime(end)
         
     the_date = start
     while the_date < end:
-        do_date(the_date, save, send, api_key)
-        the_date = the_date + datetime.timedelta(1)
+        window_end = min(the_date + window, end)
+        do_date(the_date, save, send, api_key, split, window_end)
+        the_date = window_end
 
-def do_date(the_date, save=False, send=True, api_key=None):
-    print '%s:' % the_date.strftime('%y-%m-%d')
+def window_label(start, end=None):
+    whole_days = start.time() == datetime.time() and not (end and ((end - start).seconds or (end - start).microseconds))
+    if not whole_days:
+        return '%s_%s' % (start.strftime('%y-%m-%d-%H%M'), end.strftime('%y-%m-%d-%H%M'))
+    return start.strftime('%y-%m-%d')
+
+def do_date(the_date, save=False, send=True, api_key=None, split=False, end_date=None):
+    label = window_label(as_datetime(the_date), end_date and as_datetime(end_date))
+    print '%s:' % label
     
     with debug_timer('  Overall'):
-        with debug_timer('  Get data'):
-            results = get_for_dates(the_date)
-        with debug_timer('  Parse and clean'):
-            data = clean_results(results)
-        with debug_timer('  encode'):
-            encoded = json.dumps(data.values(), default=sr_json_encoder)
-            
+        if split:
+            with debug_timer('  Get data (split)'):
+                codes = get_code_descriptions()
+                sr_rows, activity_rows = get_split_for_dates(the_date, end_date)
+            with debug_timer('  Merge and clean'):
+                data = merge_results(sr_rows, activity_rows, codes)
+        else:
+            with debug_timer('  Get data'):
+                results = get_for_dates(the_date, end_date)
+            with debug_timer('  Parse and clean'):
+                data = clean_results(results)
+    
+    # Each chunk is encoded exactly once; the same bytes get spooled and sent
+    values = data.values()
+    chunk_count = int(ceil(len(values) / float(SEND_CHUNK_SIZE)))
+    chunks = encode_chunks(values)
+    
     # Save to file
     if save:
-        f = open('nightlydata_%s.json' % the_date.strftime('%y-%m-%d'), 'w')
-        f.write(encoded)
-        f.close()
+        directory = isinstance(save, basestring) and save or '.'
+        chunks = spool_chunks(chunks, spool_path(directory, label))
         
     if send:
         default_url = DEFAULT_SEND_URL
@@ -219,39 +410,160 @@ def do_date(the_date, save=False, send=True, api_key=None):
             params['api_key'] = api_key
         
         # Upload in chunks to be nice to the receiving server
-        chunk_count = int(ceil(len(data.values()) / float(SEND_CHUNK_SIZE)))
-        if chunk_count > 1:
-            values = data.values()
-            index = 0
-            retries = 0
-            while index < chunk_count:
-                if index > 0:
-                    # Pause for a while to let the receiver calm down
-                    # Pause for longer before a retry
-                    pause = retries > 0 and (SEND_CHUNK_RETRY_PAUSE * retries) or SEND_CHUNK_PAUSE
-                    if pause > 0:
-                        print '  Pausing for %ss...' % pause
-                        time.sleep(pause)
-                chunk = values[index * SEND_CHUNK_SIZE:(index + 1) * SEND_CHUNK_SIZE]
-                encoded_chunk = json.dumps(chunk, default=sr_json_encoder)
-                with debug_timer('  Post to server - %s/%s' % (index + 1, chunk_count)):
-                    r = requests.post(send_url, params=params, data=encoded_chunk, headers={'content-type': 'application/json'})
-                    if r.status_code != 200:
-                        print '  ERROR POSTING TO SERVER. Code: %s, Text: %s' % (r.status_code, r.text)
-                        if retries < SEND_CHUNK_RETRIES:
-                            print '    Repeating...'
-                            retries += 1
-                        else:
-                            retries = 0
-                            index += 1
-                    else:
-                        retries = 0
-                        index += 1
+        for index, chunk in enumerate(chunks):
+            if index > 0 and SEND_CHUNK_PAUSE > 0:
+                # Pause for a while to let the receiver calm down
+                print '  Pausing for %ss...' % SEND_CHUNK_PAUSE
+                time.sleep(SEND_CHUNK_PAUSE)
+            post_chunk(send_url, params, chunk, '%s/%s' % (index + 1, chunk_count))
+    else:
+        with debug_timer('  Encode and save'):
+            for chunk in chunks:
+                pass
+
+
+def encode_chunks(srs, chunk_size=SEND_CHUNK_SIZE):
+    """Lazily encode a list of SRs as JSON arrays of up to chunk_size SRs."""
+    for index in xrange(0, len(srs), chunk_size):
+        yield json.dumps(srs[index:index + chunk_size], default=sr_json_encoder)
+
+
+def spool_path(directory, label):
+    return os.path.join(directory, 'nightlydata_%s.ndjson.gz' % label)
+
+
+def spool_chunks(chunks, path):
+    """
+    Pass encoded chunks through while writing each as one line of a gzipped
+    NDJSON spool file. Every line can be POSTed to /receive as-is.
+    """
+    spool = gzip.open(path, 'wb')
+    try:
+        for chunk in chunks:
+            spool.write(chunk)
+            spool.write('\n')
+            yield chunk
+    finally:
+        spool.close()
+
+
+def post_chunk(send_url, params, encoded_chunk, label=''):
+    """
+    POST one encoded chunk to the receiving server, retrying with increasing
+    pauses on errors. Returns whether the server accepted it.
+    """
+    retries = 0
+    while True:
+        try:
+            with debug_timer('  Post to server - %s' % label):
+                r = requests.post(send_url, params=params, data=encoded_chunk, headers={'content-type': 'application/json'})
+        except requests.RequestException, e:
+            # e.g. the server is down or reset the connection; retry like an error response
+            print '  ERROR POSTING TO SERVER: %s' % e
         else:
-            with debug_timer('  Post to server'):
-                r = requests.post(send_url, params=params, data=encoded, headers={'content-type': 'application/json'})
-                if r.status_code != 200:
-                    print '  ERROR POSTING TO SERVER. Code: %s, Text: %s' % (r.status_code, r.text)
+            if r.status_code == 200:
+                return True
+            print '  ERROR POSTING TO SERVER. Code: %s, Text: %s' % (r.status_code, r.text)
+        
+        if retries >= SEND_CHUNK_RETRIES:
+            return False
+        print '    Repeating...'
+        retries += 1
+        # Pause for longer before each retry
+        pause = SEND_CHUNK_RETRY_PAUSE * retries
+        print '  Pausing for %ss...' % pause
+        time.sleep(pause)
+
+
+def open_saved(path):
+    """Open a saved output file, whether or not it's gzipped."""
+    f = open(path, 'rb')
+    magic = f.read(2)
+    f.seek(0)
+    if magic == '\x1f\x8b':
+        f.close()
+        return gzip.open(path, 'rb')
+    return f
+
+
+def saved_chunks(path):
+    """
+    Yield the encoded chunks in a saved output file. NDJSON spool files
+    already hold one chunk per line; older files hold the whole day as one
+    JSON array, which is re-chunked.
+    """
+    f = open_saved(path)
+    try:
+        if '.ndjson' in os.path.basename(path):
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield line
+        else:
+            # SRs were saved already encoded, so dates are still "date::" strings
+            for chunk in encode_chunks(json.load(f)):
+                yield chunk
+    finally:
+        f.close()
+
+
+def load_checkpoint(path):
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def save_checkpoint(checkpoint, path):
+    # write and rename so an interruption never leaves a half-written checkpoint
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(checkpoint, f)
+    os.rename(temp_path, path)
+
+
+def do_replay(directory, send=True, api_key=None, checkpoint_path=None):
+    """
+    Send saved output files in a directory to the receiving server without
+    touching the reporting database. The number of chunks acknowledged for
+    each file is recorded in a checkpoint file (REPLAY_CHECKPOINT in the
+    directory by default), so an interrupted replay resumes where it stopped.
+    Returns False if a chunk could not be sent.
+    """
+    checkpoint_path = checkpoint_path or os.path.join(directory, REPLAY_CHECKPOINT)
+    checkpoint = load_checkpoint(checkpoint_path)
+    
+    default_url = DEFAULT_SEND_URL
+    send_url = (isinstance(send, basestring) and send or default_url) + 'receive'
+    params = {}
+    if api_key:
+        params['api_key'] = api_key
+    
+    paths = []
+    for pattern in REPLAY_PATTERNS:
+        paths.extend(glob.glob(os.path.join(directory, pattern)))
+    
+    for path in sorted(paths):
+        name = os.path.basename(path)
+        done = checkpoint.get(name, 0)
+        print '%s:' % name
+        if done:
+            print '  Resuming after %s chunks' % done
+        
+        sent = 0
+        for index, chunk in enumerate(saved_chunks(path)):
+            if index < done:
+                continue
+            if sent > 0 and SEND_CHUNK_PAUSE > 0:
+                time.sleep(SEND_CHUNK_PAUSE)
+            if not post_chunk(send_url, params, chunk, index + 1):
+                print '  Stopping; run again to resume from chunk %s' % (index + 1)
+                return False
+            sent += 1
+            checkpoint[name] = index + 1
+            save_checkpoint(checkpoint, checkpoint_path)
+    
+    return True
 
 
 def do_types(save=False, send=True, api_key=None):
@@ -282,26 +594,37 @@ def do_types(save=False, send=True, api_key=None):
 if __name__ == '__main__':
     parser = OptionParser()
     parser.add_option("-d", "--days", dest="days", default=1, type="int", help="Number of days to capture data for. Using --start/--end overrides this.")
-    parser.add_option("-s", "--start", dest="start", help="Start date in the format 'YYYY-MM-DD'", default=None)
-    parser.add_option("-e", "--end", dest="end", help="End date (non-inclusive) in the format 'YYYY-MM-DD'", default=None)
+    parser.add_option("-s", "--start", dest="start", help="Start date in the format 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM'", default=None)
+    parser.add_option("-e", "--end", dest="end", help="End date (non-inclusive) in the format 'YYYY-MM-DD' or 'YYYY-MM-DD HH:MM'", default=None)
+    parser.add_option("-w", "--window", dest="window", default=24, type="float", help="Number of hours to collect in each query (default 24)")
     parser.add_option("-u", "--url", dest="url", help="URL to send to", default=None)
     parser.add_option("-p", "--post", dest="post", action="store_true", help="Whether to post the data to a server (use --url to specify what URL)")
     parser.add_option("-t", "--types", dest="update_types", action="store_true", help="Update service type information", default=False)
-    parser.add_option("-o", "--output", dest="output", help="Output JSON file for each day to this directory", default=None)
+    parser.add_option("-o", "--output", dest="output", help="Save a gzipped NDJSON spool file of the chunks for each day to this directory", default=None)
     parser.add_option("-k", "--key", dest="api_key", help="API key to use for the receiving server", default=None)
+    parser.add_option("-r", "--replay", dest="replay", help="Send the saved output files in this directory instead of querying the database (resumes from its checkpoint)", default=None)
+    parser.add_option("--split", dest="split", action="store_true", help="Query SRs and activities separately instead of with one join", default=False)
     (options, args) = parser.parse_args()
     
-    end_day = datetime.date.today()
+    def parse_time(value):
+        try:
+            return datetime.datetime.strptime(value, "%Y-%m-%d %H:%M")
+        except ValueError:
+            return datetime.datetime.strptime(value, "%Y-%m-%d")
+    
+    end_day = as_datetime(datetime.date.today())
     start_day = end_day - datetime.timedelta(options.days)
     if options.start:
         try:
-            start_time = datetime.datetime.strptime(options.start, "%Y-%m-%d")
-            start_day = start_time.date()
+            start_day = parse_time(options.start)
             if options.end:
-                end_time = datetime.datetime.strptime(options.end, "%Y-%m-%d")
-                end_day = end_time.date()
+                end_day = parse_time(options.end)
         except:
-            sys.exit('Dates must be a day the format "YYYY-MM-DD"')
+            sys.exit('Dates must be in the format "YYYY-MM-DD" or "YYYY-MM-DD HH:MM"')
+    
+    window = datetime.timedelta(hours=options.window)
+    if window <= datetime.timedelta(0):
+        sys.exit('--window must be a positive number of hours')
     
     url = None
     if options.post or options.url:
@@ -311,6 +634,14 @@ if __name__ == '__main__':
     
     api_key = options.api_key or OPEN311_API_KEY
     
+    if options.replay:
+        print 'Replaying saved data from %s...' % options.replay
+        if not do_replay(options.replay, send=url or DEFAULT_SEND_URL, api_key=api_key):
+            sys.exit(1)
+        sys.exit(0)
+    
+    connect_db()
+    
     if options.update_types:
         print 'Updating service type information...'
         do_types(save=output, send=url, api_key=api_key)
@@ -318,4 +649,4 @@ if __name__ == '__main__':
     
     # REQUESTS
     print 'Gathering data between %s and %s...' % (start_day, end_day)
-    do_date_range(start_day, end_day, save=output, send=url, api_key=api_key)
+    do_date_range(start_day, end_day, save=output, send=url, api_key=api_key, split=options.split, window=window)
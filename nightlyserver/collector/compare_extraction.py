@@ -0,0 +1,92 @@
+"""
+Compare the collector's join extraction mode (get_for_dates + clean_results)
+with the split mode (get_split_for_dates + merge_results) against a local
+SQLite stand-in of the reporting database. Checks that both produce the same
+SRs and reports time, rows and (approximate) bytes transferred for each.
+
+Never connects to Oracle:
+
+    python compare_extraction.py --srs 20000 --activities 8
+"""
+
+import datetime
+import time
+from optparse import OptionParser
+import collector
+import sqlite_standin
+
+
+def transferred_size(rows):
+    """Rough size of a result set: the length of every non-null value."""
+    cells = 0
+    size = 0
+    for row in rows:
+        cells += len(row)
+        for value in row:
+            if value is not None:
+                size += len(str(value))
+    return cells, size
+
+
+def normalize(srs):
+    for sr in srs.itervalues():
+        sr['activities'].sort(key=lambda activity: activity['act.EID'])
+    return srs
+
+
+def run_join(the_date):
+    start = time.time()
+    results = collector.get_for_dates(the_date)
+    fetched = time.time()
+    data = collector.clean_results(results)
+    done = time.time()
+    return data, fetched - start, done - fetched, len(results), transferred_size(results)
+
+
+def run_split(the_date):
+    start = time.time()
+    collector.code_descriptions = None
+    codes = collector.get_code_descriptions()
+    sr_rows, activity_rows = collector.get_split_for_dates(the_date)
+    fetched = time.time()
+    data = collector.merge_results(sr_rows, activity_rows, codes)
+    done = time.time()
+    cells, size = transferred_size(sr_rows)
+    activity_cells, activity_size = transferred_size(activity_rows)
+    code_cells, code_size = transferred_size([(key[0], key[1], value) for key, value in codes.iteritems()])
+    row_count = len(sr_rows) + len(activity_rows) + len(codes)
+    return data, fetched - start, done - fetched, row_count, (cells + activity_cells + code_cells, size + activity_size + code_size)
+
+
+def report(name, result):
+    data, fetch_time, clean_time, row_count, (cells, size) = result
+    print '%s:' % name
+    print '  SRs:         %s' % len(data)
+    print '  Rows:        %s' % row_count
+    print '  Cells:       %s' % cells
+    print '  Bytes (est): %s' % size
+    print '  Fetch:       %.3fs' % fetch_time
+    print '  Clean/merge: %.3fs' % clean_time
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("-n", "--srs", dest="srs", default=10000, type="int", help="Number of synthetic SRs")
+    parser.add_option("-a", "--activities", dest="activities", default=8, type="int", help="Average number of activities per SR")
+    parser.add_option("--db", dest="db", default=':memory:', help="SQLite file to build the stand-in in (must not exist)")
+    (options, args) = parser.parse_args()
+
+    the_date = datetime.datetime(2012, 1, 1)
+    print 'Building stand-in with %s SRs...' % options.srs
+    collector.connect_db(sqlite_standin.build(options.db, sr_count=options.srs,
+        activities_per_sr=options.activities, start_date=the_date))
+
+    join_result = run_join(the_date)
+    split_result = run_split(the_date)
+    report('Join', join_result)
+    report('Split', split_result)
+
+    if normalize(join_result[0]) == normalize(split_result[0]):
+        print 'Results match.'
+    else:
+        print 'RESULTS DIFFER!'
@@ -0,0 +1,175 @@
+"""
+A local SQLite stand-in for the parts of the reporting database the collector
+reads (SERVICE_REQUESTS, SR_ACTIVITIES and CODE_DESCRIPTIONS), filled with
+synthetic data. Lets you run the collector's queries outside the city network:
+
+    import collector, sqlite_standin
+    collector.connect_db(sqlite_standin.build(sr_count=5000))
+"""
+
+import datetime
+import random
+import sqlite3
+
+# Date columns are declared as TIMESTAMP so sqlite3 hands back datetimes,
+# just like cx_Oracle does.
+DATE_FIELDS = (
+    "STATUS_DATE",
+    "CREATED_DATE",
+    "UPDATED_DATE",
+    "DUE_DATE",
+    "COMPLETE_DATE",
+    "COMPLETED_DATE_TIMESTAMP",
+)
+
+TYPE_CODES = ('GRAF', 'SIE', 'SFE', 'TBC', 'PHF', 'SGA', 'BBA', 'SKA', 'EAE', 'SCB', 'SEL', 'HFB', 'PHQ', 'PBE')
+GROUP_CODES = ('DSS', 'CDOT', 'DWM', 'DOB', 'HEALTH', 'FORESTRY')
+ACTIVITY_CODES = ('INSPECT', 'ASSIGN', 'REVIEW', 'COMPLETE', 'BAIT', 'TRIM', 'REMOVE', 'CALLBACK')
+STATUS_CODES = ('O-OPEN', 'C-COMPLETED', 'C-DUP', 'O-DUP')
+STREET_NAMES = ('STATE', 'CLARK', 'HALSTED', 'ASHLAND', 'WESTERN', 'PULASKI', 'CICERO', 'MADISON')
+
+
+def column_type(field):
+    if field in DATE_FIELDS:
+        return 'TIMESTAMP'
+    if field == 'EID' or field.endswith('_EID'):
+        return 'INTEGER'
+    if field in ('X_COORDINATE', 'Y_COORDINATE'):
+        return 'REAL'
+    return 'TEXT'
+
+
+def create_schema(connection, sr_fields, activity_fields):
+    cur = connection.cursor()
+    cur.execute('CREATE TABLE SERVICE_REQUESTS (%s)' % ', '.join(
+        ['%s %s' % (field, column_type(field)) for field in sr_fields]))
+    cur.execute('CREATE TABLE SR_ACTIVITIES (%s)' % ', '.join(
+        ['%s %s' % (field, column_type(field)) for field in activity_fields]))
+    cur.execute('CREATE TABLE CODE_DESCRIPTIONS (TYPE_CODE TEXT, CODE_CODE TEXT, DESCRIPTION TEXT)')
+    cur.execute('CREATE INDEX srs_updated ON SERVICE_REQUESTS (UPDATED_DATE)')
+    cur.execute('CREATE INDEX act_sr ON SR_ACTIVITIES (SERVICE_REQUEST_EID)')
+    connection.commit()
+
+
+def make_sr(eid, start_date, days, rand):
+    created = start_date + datetime.timedelta(seconds=rand.randint(0, days * 86400 - 1))
+    updated = min(created + datetime.timedelta(seconds=rand.randint(0, 3600 * 6)),
+                  start_date + datetime.timedelta(days, -1))
+    return {
+        "EID": eid,
+        "SERVICE_REQUEST_NUM": '%s-%08d' % (created.strftime('%y'), eid),
+        "TYPE_CODE": rand.choice(TYPE_CODES),
+        "GROUP_CODE": rand.choice(GROUP_CODES),
+        "PRIORITY_CODE": 'STANDARD',
+        "STATUS_CODE": rand.choice(STATUS_CODES),
+        "STATUS_DATE": updated,
+        "ORIG_SERVICE_REQUEST_EID": rand.random() < 0.2 and rand.randint(1, max(1, eid - 1)) or None,
+        "CREATION_REASON_CODE": 'NEW',
+        "RELATED_REASON_CODE": None,
+        "METHOD_RECEIVED_CODE": rand.choice(('PHONE', 'INTERNET', 'MOBILE')),
+        "VALID_SEGMENT_FLAG": 'Y',
+        "STREET_NUMBER": str(rand.randint(1, 12000)),
+        "STREET_NAME_PREFIX": rand.choice(('N', 'S', 'E', 'W')),
+        "STREET_NAME": rand.choice(STREET_NAMES),
+        "STREET_NAME_SUFFIX": 'ST',
+        "STREET_SUFFIX_DIRECTION": None,
+        "CITY": 'CHICAGO',
+        "STATE_CODE": 'IL',
+        "COUNTY": 'COOK',
+        "ZIP_CODE": str(rand.randint(60601, 60661)),
+        "UNIT_NUMBER": None,
+        "FLOOR": None,
+        "BUILDING_NAME": None,
+        "LOCATION_DETAILS": 'Near the alley',
+        "X_COORDINATE": rand.uniform(1100000, 1200000),
+        "Y_COORDINATE": rand.uniform(1810000, 1950000),
+        "DETAILS": 'Synthetic service request %s' % eid,
+        "CREATED_DATE": created,
+        "UPDATED_DATE": updated,
+        "GEO_AREA_CODE": 'WARD',
+        "GEO_AREA_VALUE": str(rand.randint(1, 50)),
+    }
+
+
+def make_activity(eid, sr, rand):
+    created = sr['CREATED_DATE'] + datetime.timedelta(seconds=rand.randint(0, 3600))
+    completed = rand.random() < 0.6 and created + datetime.timedelta(hours=1) or None
+    return {
+        "EID": eid,
+        "SERVICE_REQUEST_EID": sr['EID'],
+        "ACTIVITY_CODE": rand.choice(ACTIVITY_CODES),
+        "DUE_DATE": created + datetime.timedelta(days=7),
+        "COMPLETE_DATE": completed,
+        "ASSIGNED_STAFF_EID": rand.randint(1, 500),
+        "OUTCOME_CODE": completed and 'DONE' or None,
+        "DETAILS": 'Synthetic activity %s' % eid,
+        "BUSINESS_CODES": None,
+        "CREATED_DATE": created,
+        "CREATED_BY_EID": rand.randint(1, 500),
+        "UPDATED_DATE": completed or created,
+        "UPDATED_BY_EID": rand.randint(1, 500),
+        "PRECEDED_BY_EID": None,
+        "COMPLETED_DATE_TIMESTAMP": completed,
+    }
+
+
+def populate(connection, sr_fields, activity_fields, sr_count=1000, activities_per_sr=8,
+             start_date=datetime.datetime(2012, 1, 1), days=1, seed=311, duplicate_every=100):
+    """
+    Fill the stand-in with sr_count SRs spread over the given days, each with
+    an average of activities_per_sr activities. Every duplicate_every-th SR
+    reuses the previous SR's number (with its own EID and activities), as
+    happens in the real data.
+    """
+    rand = random.Random(seed)
+    cur = connection.cursor()
+
+    codes = [('GROUP', code, 'Department %s' % code) for code in GROUP_CODES]
+    codes.extend([('SRACTVTY', code, 'Activity %s' % code.title()) for code in ACTIVITY_CODES])
+    codes.extend([('SRSRTYPE', code, 'Service %s' % code) for code in TYPE_CODES])
+    cur.executemany('INSERT INTO CODE_DESCRIPTIONS VALUES (?, ?, ?)', codes)
+
+    sr_insert = 'INSERT INTO SERVICE_REQUESTS (%s) VALUES (%s)' % (
+        ', '.join(sr_fields), ', '.join(['?'] * len(sr_fields)))
+    activity_insert = 'INSERT INTO SR_ACTIVITIES (%s) VALUES (%s)' % (
+        ', '.join(activity_fields), ', '.join(['?'] * len(activity_fields)))
+
+    activity_eid = 1
+    srs = []
+    activities = []
+    previous_number = None
+    for eid in xrange(1, sr_count + 1):
+        sr = make_sr(eid, start_date, days, rand)
+        if duplicate_every and eid % duplicate_every == 0 and previous_number:
+            sr['SERVICE_REQUEST_NUM'] = previous_number
+        previous_number = sr['SERVICE_REQUEST_NUM']
+        srs.append([sr[field] for field in sr_fields])
+        for index in xrange(rand.randint(0, activities_per_sr * 2)):
+            activity = make_activity(activity_eid, sr, rand)
+            activities.append([activity[field] for field in activity_fields])
+            activity_eid += 1
+
+        if len(srs) >= 1000:
+            cur.executemany(sr_insert, srs)
+            cur.executemany(activity_insert, activities)
+            srs = []
+            activities = []
+
+    cur.executemany(sr_insert, srs)
+    cur.executemany(activity_insert, activities)
+    connection.commit()
+
+
+def build(path=':memory:', sr_fields=None, activity_fields=None, **kwargs):
+    """
+    Create and populate a stand-in database. Takes the same keyword
+    arguments as populate(). Field lists default to the collector's.
+    """
+    if sr_fields is None or activity_fields is None:
+        import collector
+        sr_fields = sr_fields or collector.SR_FIELDS
+        activity_fields = activity_fields or collector.ACTIVITY_FIELDS
+    connection = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
+    create_schema(connection, sr_fields, activity_fields)
+    populate(connection, sr_fields, activity_fields, **kwargs)
+    return connection
@@ -0,0 +1,225 @@
+'''
+Rollups of the cases for the analytics endpoints, kept up to date as SRs are
+received. To rebuild them from scratch, see manage.py.
+'''
+
+from db_info import *
+
+
+def case_type_path(sr_case):
+    '''The service codes of a case's requests, in the order they were created.'''
+    requests = sr_case['requests']
+    # Dates lacking timezones can't be compared with ones that have them (see update_case_metadata)
+    try:
+        requests = sorted(requests, key=lambda sr: sr['srs-CREATED_DATE'])
+    except TypeError:
+        pass
+    return [sr['srs-TYPE_CODE'] for sr in requests]
+
+
+def touched_case_ids(srs, db):
+    '''
+    IDs of the cases that received SRs (as POSTed to /receive) are indexed
+    under, or whose parents are. Call before saving the SRs to get the cases
+    they might be merged out of and again after to get the ones they're in.
+    '''
+    eids = []
+    for sr in srs:
+        eids.append(sr.get('srs.EID'))
+        if sr.get('srs.ORIG_SERVICE_REQUEST_EID'):
+            eids.append(sr['srs.ORIG_SERVICE_REQUEST_EID'])
+    case_ids = set()
+    for index in range(0, len(eids), 1000):
+        for entry in db[COLLECTION_CASE_INDEX].find({'EID': {'$in': eids[index:index + 1000]}}, ['case']):
+            case_ids.add(entry['case'])
+    return case_ids
+
+
+def path_key(service_code, path):
+    return '%s:%s' % (service_code, '|'.join(path))
+
+
+def count_case_path(db, service_code, path, increment):
+    '''
+    Paths are counted under the case's service_code (that of its first
+    request, as everywhere else), which needn't be the first in its path.
+    '''
+    db[COLLECTION_FOLLOW_ON_PATHS].update(
+        {'_id': path_key(service_code, path)},
+        {'$set': {'service_code': service_code, 'path': path}, '$inc': {'count': increment}},
+        upsert=True)
+
+
+def refresh_follow_on_paths(db, case_ids):
+    '''
+    Update the follow-on path counts for the given cases, which may have
+    changed, been merged into other cases or been removed. Each case's
+    counted path is kept in COLLECTION_FOLLOW_ON_CASES, so only the cases
+    whose paths actually changed are recounted.
+    '''
+    for case_id in case_ids:
+        sr_case = db[COLLECTION_CASES].find_one({'_id': case_id}, ['service_code', 'requests.srs-TYPE_CODE', 'requests.srs-CREATED_DATE'])
+        path = sr_case and case_type_path(sr_case) or None
+        service_code = sr_case and sr_case['service_code'] or None
+        counted = db[COLLECTION_FOLLOW_ON_CASES].find_one({'_id': case_id})
+        if counted and counted['path'] == path and counted['service_code'] == service_code:
+            continue
+        if counted:
+            count_case_path(db, counted['service_code'], counted['path'], -1)
+        if path:
+            count_case_path(db, service_code, path, 1)
+            db[COLLECTION_FOLLOW_ON_CASES].save({'_id': case_id, 'service_code': service_code, 'path': path})
+        else:
+            db[COLLECTION_FOLLOW_ON_CASES].remove({'_id': case_id})
+    db[COLLECTION_FOLLOW_ON_PATHS].remove({'count': {'$lte': 0}})
+
+
+def rebuild_follow_on_paths(db):
+    '''Recount every case's follow-on path from scratch.'''
+    counts = {}
+    counted = []
+    for sr_case in db[COLLECTION_CASES].find({}, ['service_code', 'requests.srs-TYPE_CODE', 'requests.srs-CREATED_DATE']):
+        path = case_type_path(sr_case)
+        key = (sr_case['service_code'], tuple(path))
+        counts[key] = counts.get(key, 0) + 1
+        counted.append({'_id': sr_case['_id'], 'service_code': sr_case['service_code'], 'path': path})
+
+    db[COLLECTION_FOLLOW_ON_PATHS].drop()
+    db[COLLECTION_FOLLOW_ON_CASES].drop()
+    paths = [{'_id': path_key(service_code, path), 'service_code': service_code, 'path': list(path), 'count': count}
+        for (service_code, path), count in counts.iteritems()]
+    for index in range(0, len(paths), 1000):
+        db[COLLECTION_FOLLOW_ON_PATHS].insert(paths[index:index + 1000])
+    for index in range(0, len(counted), 1000):
+        db[COLLECTION_FOLLOW_ON_CASES].insert(counted[index:index + 1000])
+    ensure_analytics_indexes(db)
+
+
+def ensure_analytics_indexes(db):
+    db[COLLECTION_FOLLOW_ON_PATHS].ensure_index('service_code')
+    db[COLLECTION_CASE_STATS].ensure_index('day')
+    db[COLLECTION_CASE_STATS].ensure_index('service_code')
+
+
+# The dimensions cases are counted by in COLLECTION_CASE_STATS
+STATS_DIMENSIONS = ('service_code', 'status', 'ward', 'day')
+
+
+def case_stats_key(sr_case):
+    '''
+    The CaseStats row a case is counted in: its service, status, ward (of
+    its first SR, as in sr_format.format_case) and the day it was requested.
+    Takes a case with its metadata set (see handle_srs.update_case_metadata).
+    '''
+    requested = sr_case.get('requested_datetime')
+    if hasattr(requested, 'date'):
+        requested = requested.date().isoformat()
+    elif requested:
+        requested = str(requested)[:10]
+    return {
+        'service_code': sr_case.get('service_code'),
+        'status': sr_case.get('status'),
+        'ward': sr_case['requests'][0].get('srs-GEO_AREA_VALUE'),
+        'day': requested,
+    }
+
+
+def stats_row_id(key):
+    return '|'.join([unicode(key[dimension]) for dimension in STATS_DIMENSIONS])
+
+
+def count_case_stats(db, before, after):
+    '''
+    Move a case from one CaseStats row to another when it's created (before
+    is None), changes status (or anything else counted) or is removed
+    (after is None). Takes keys from case_stats_key().
+    '''
+    if before == after:
+        return
+    if before:
+        db[COLLECTION_CASE_STATS].update({'_id': stats_row_id(before)}, {'$inc': {'count': -1}})
+    if after:
+        db[COLLECTION_CASE_STATS].update({'_id': stats_row_id(after)}, {'$set': after, '$inc': {'count': 1}}, upsert=True)
+
+
+def rebuild_case_stats(db):
+    '''Recount every case into CaseStats from scratch.'''
+    counts = {}
+    fields = ['service_code', 'status', 'requested_datetime', 'requests.srs-GEO_AREA_VALUE']
+    for sr_case in db[COLLECTION_CASES].find({}, fields):
+        key = case_stats_key(sr_case)
+        row_id = stats_row_id(key)
+        if row_id in counts:
+            counts[row_id]['count'] += 1
+        else:
+            key['_id'] = row_id
+            key['count'] = 1
+            counts[row_id] = key
+
+    db[COLLECTION_CASE_STATS].drop()
+    rows = counts.values()
+    for index in range(0, len(rows), 1000):
+        db[COLLECTION_CASE_STATS].insert(rows[index:index + 1000])
+    ensure_analytics_indexes(db)
+
+
+def case_stats(db, group_by, service_codes, statuses=None, wards=None, start_day=None, end_day=None):
+    '''
+    Case counts from CaseStats grouped by any of STATS_DIMENSIONS (or a
+    single total if group_by is empty), limited to the given service codes
+    and, optionally, statuses, wards and a range of days (inclusive
+    'YYYY-MM-DD' strings). Largest counts first.
+    '''
+    match = {'service_code': {'$in': list(service_codes)}, 'count': {'$gt': 0}}
+    if statuses:
+        match['status'] = {'$in': list(statuses)}
+    if wards:
+        match['ward'] = {'$in': list(wards)}
+    if start_day or end_day:
+        match['day'] = {}
+        if start_day:
+            match['day']['$gte'] = start_day
+        if end_day:
+            match['day']['$lte'] = end_day
+
+    group = {'_id': dict([(dimension, '$' + dimension) for dimension in group_by]) or None, 'count': {'$sum': '$count'}}
+    result = db[COLLECTION_CASE_STATS].aggregate([
+        {'$match': match},
+        {'$group': group},
+        {'$sort': {'count': -1}},
+    ])
+    data = []
+    for row in result['result']:
+        stats = dict([(dimension, row['_id'][dimension]) for dimension in group_by])
+        stats['count'] = row['count']
+        data.append(stats)
+    return data
+
+
+def follow_ons_for_services(db, service_codes, max_paths=None):
+    '''
+    Follow-on statistics for cases starting with each of the given service
+    codes: how many cases there are, how many have follow-ons and the paths
+    of service codes they take, most common first.
+    '''
+    results = {}
+    for code in service_codes:
+        results[code] = {
+            'service_code': code,
+            'case_count': 0,
+            'followed_count': 0,
+            'paths': [],
+        }
+    for row in db[COLLECTION_FOLLOW_ON_PATHS].find({'service_code': {'$in': list(service_codes)}}):
+        result = results[row['service_code']]
+        result['case_count'] += row['count']
+        if len(row['path']) > 1:
+            result['followed_count'] += row['count']
+            result['paths'].append({'path': row['path'], 'count': row['count']})
+
+    for result in results.itervalues():
+        result['paths'].sort(key=lambda path: path['count'], reverse=True)
+        if max_paths:
+            result['paths'] = result['paths'][:max_paths]
+    return [results[code] for code in service_codes]
+
@@ -1,16 +1,20 @@
 import os
 import json
+import zlib
 import datetime
 import traceback
 from contextlib import closing
 import logging
-from flask import Flask, render_template, request, abort, make_response, g
+from flask import Flask, Response, render_template, request, abort, make_response, g
 import pymongo
 from dateutil.parser import parse as parse_date
 from handle_srs import *
 from accepted_services import *
 from db_info import *
 import sr_format
+import analytics
+import changes
+import geo
 
 # Config
 # NOTE: in production, you should pull in different config information.
@@ -26,6 +30,20 @@ DB_NAME = 'NightlySRs'
 REQUIRE_KEY = False
 MAX_PAGE_SIZE = 250
 DEFAULT_PAGE_SIZE = 50
+MAX_FOLLOW_ON_PATHS = 100
+# meters, for lat/long queries without a radius
+DEFAULT_RADIUS = 500
+MAX_RADIUS = 50000
+# how long /api/changes.json tokens stay good for
+CHANGES_TTL_DAYS = 30
+# how long a change can take to be written once it has a sequence number
+CHANGES_GRACE_SECONDS = 30
+# bulk exports: cases fetched per round trip, bytes per streamed chunk
+# and how many exports each API key (or address) may start per period
+EXPORT_BATCH_SIZE = 1000
+EXPORT_CHUNK_SIZE = 64 * 1024
+EXPORT_RATE_LIMIT = 5
+EXPORT_RATE_PERIOD = 60 * 60
 
 app = Flask(__name__)
 
@@ -52,6 +70,52 @@ def flattened_arg_list(arg_name):
     return flattened
 
 
+def float_arg_list(arg_name, count):
+    values = flattened_arg_list(arg_name)
+    if values is None:
+        return None
+    try:
+        values = map(float, values)
+    except ValueError:
+        raise ValueError('"%s" must be numbers' % arg_name)
+    if len(values) != count:
+        raise ValueError('"%s" must be %s comma-separated numbers' % (arg_name, count))
+    return values
+
+
+def geo_filter():
+    '''
+    Build a query on case locations from the lat/long/radius (Open311-style,
+    radius in meters) or bbox (min long,min lat,max long,max lat) args.
+    Returns None if there are none; raises ValueError if they're invalid.
+    '''
+    if 'bbox' in request.args:
+        west, south, east, north = float_arg_list('bbox', 4)
+        if not (-180 <= west < east <= 180 and -90 <= south < north <= 90):
+            raise ValueError('"bbox" must be min longitude,min latitude,max longitude,max latitude')
+        return geo.bbox_query(west, south, east, north)
+    
+    if 'lat' in request.args or 'long' in request.args:
+        try:
+            latitude = float(request.args['lat'])
+            longitude = float(request.args['long'])
+            radius = float(request.args.get('radius', app.config['DEFAULT_RADIUS']))
+        except (KeyError, ValueError):
+            raise ValueError('"lat" and "long" (and "radius", if given) must all be numbers')
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180 and 0 < radius <= app.config['MAX_RADIUS']):
+            raise ValueError('"lat" or "long" is out of range, or "radius" is not between 0 and %s meters' % app.config['MAX_RADIUS'])
+        return geo.radius_query(latitude, longitude, radius)
+    
+    return None
+
+
+def bad_request(message):
+    return make_response(
+        json.dumps({'error': message}),
+        400,
+        {'Content-type': 'application/json'})
+
+
 def parse_bool(input):
     '''Parse a bool value from a string. Useful for parsing ENV vars or query/form args.'''
     if input == True or input == False:
@@ -83,10 +147,14 @@ def always_require_api_key(*args, **kwargs):
 @app.before_request
 def set_api_rights(*args, **kwargs):
     g.accepted_services = ACCEPTED_SERVICES
+    # only set for keys that actually exist (REQUIRE_KEY may be off)
+    g.api_key = None
     if 'api_key' in request.args:
         with connect_db() as db:
             key = request.args['api_key']
             key_info = db[app.config['DB_NAME']][COLLECTION_API_KEYS].find_one({'_id': key})
+            if key_info:
+                g.api_key = key
             if key_info and 'accepted_services' in key_info:
                 g.accepted_services = tuple(key_info['accepted_services'])
 
@@ -151,22 +219,12 @@ def api_get_request(request_id):
     return ("No such service request", 404, None)
 
 
-@app.route("/api/requests.json")
-def api_get_requests():
-    # should we return old-style results alongside new style?
-    legacy = parse_bool(request.args.get('legacy', True))
-    
-    # paging
-    page_size = app.config['DEFAULT_PAGE_SIZE']
-    if 'page_size' in request.args and request.args['page_size'].isdigit():
-        page_size = int(request.args['page_size'])  
-    page_size = min(app.config['MAX_PAGE_SIZE'], page_size)
-    if page_size <= 0:
-        page_size = app.config['DEFAULT_PAGE_SIZE']
-    page = 1
-    if 'page' in request.args and request.args['page'].isdigit():
-        page = max(1, int(request.args['page']))
-    
+def requests_query():
+    '''
+    Build the query on cases and the field to order them by from the
+    /api/requests.json filter args (everything but paging). Raises
+    ValueError if they're invalid.
+    '''
     # date ranges
     start_requested_datetime = request.args.get('start_date', type=parse_date)
     end_requested_datetime = request.args.get('end_date', type=parse_date)
@@ -188,36 +246,77 @@ def api_get_requests():
         service_code = g.accepted_services
     
     
+    # CUSTOM: full-text search of the SRs' and activities' details
+    search_terms = request.args.get('q', '').strip()
+    
     # CUSTOM: datetime_type (one of 'requested' or 'updated')
     order_default = (not start_requested_datetime and not end_requested_datetime and (start_updated_datetime or end_updated_datetime)) and 'updated' or 'requested'
     order_by = request.args.get('order_by', default=order_default, type=lambda value: value in ('requested', 'updated') and value or order_default)
     order_by = '%s_datetime' % order_by
     
+    location_query = geo_filter()
+    
+    query = {}
+    if location_query:
+        query[CASE_GEO_FIELD] = location_query
+    if start_requested_datetime or end_requested_datetime:
+        date_query = {}
+        if start_requested_datetime:
+            date_query['$gte'] = start_requested_datetime
+        if end_requested_datetime:
+            date_query['$lte'] = end_requested_datetime
+        query['requested_datetime'] = date_query
+    if start_updated_datetime or end_updated_datetime:
+        date_query = {}
+        if start_updated_datetime:
+            date_query['$gte'] = start_updated_datetime
+        if end_updated_datetime:
+            date_query['$lte'] = end_updated_datetime
+        query['updated_datetime'] = date_query
+    if service_request_id:
+        query['_id'] = {'$in': service_request_id}
+    if service_code:
+        query['service_code'] = {'$in': service_code}
+    if status:
+        query['status'] = {'$in': status}
+    if search_terms:
+        query['$text'] = {'$search': search_terms}
+    return query, order_by
+
+
+@app.route("/api/requests.json")
+def api_get_requests():
+    # should we return old-style results alongside new style?
+    legacy = parse_bool(request.args.get('legacy', True))
+    
+    # paging
+    page_size = app.config['DEFAULT_PAGE_SIZE']
+    if 'page_size' in request.args and request.args['page_size'].isdigit():
+        page_size = int(request.args['page_size'])  
+    page_size = min(app.config['MAX_PAGE_SIZE'], page_size)
+    if page_size <= 0:
+        page_size = app.config['DEFAULT_PAGE_SIZE']
+    page = 1
+    if 'page' in request.args and request.args['page'].isdigit():
+        page = max(1, int(request.args['page']))
+    
+    try:
+        query, order_by = requests_query()
+    except ValueError, e:
+        return bad_request(str(e))
+    
     with closing(connect_db()) as db:
         actual_db = db[DB_NAME]
-        query = {}
-        if start_requested_datetime or end_requested_datetime:
-            date_query = {}
-            if start_requested_datetime:
-                date_query['$gte'] = start_requested_datetime
-            if end_requested_datetime:
-                date_query['$lte'] = end_requested_datetime
-            query['requested_datetime'] = date_query
-        if start_updated_datetime or end_updated_datetime:
-            date_query = {}
-            if start_updated_datetime:
-                date_query['$gte'] = start_updated_datetime
-            if end_updated_datetime:
-                date_query['$lte'] = end_updated_datetime
-            query['updated_datetime'] = date_query
-        if service_request_id:
-            query['_id'] = {'$in': service_request_id}
-        if service_code:
-            query['service_code'] = {'$in': service_code}
-        if status:
-            query['status'] = {'$in': status}
-            
-        srs = actual_db[COLLECTION_CASES].find(query).sort(order_by, pymongo.DESCENDING).skip((page - 1) * page_size).limit(page_size)
+        # searches are ordered by relevance unless an order is asked for
+        if '$text' in query:
+            srs = actual_db[COLLECTION_CASES].find(query, {'score': {'$meta': 'textScore'}})
+            if 'order_by' in request.args:
+                srs = srs.sort(order_by, pymongo.DESCENDING)
+            else:
+                srs = srs.sort([('score', {'$meta': 'textScore'})])
+        else:
+            srs = actual_db[COLLECTION_CASES].find(query).sort(order_by, pymongo.DESCENDING)
+        srs = srs.skip((page - 1) * page_size).limit(page_size)
         data = map(lambda sr: sr_format.format_case(sr, actual_db, legacy=legacy), srs)
         def json_formatter(obj):
             if isinstance(obj, datetime.datetime):
@@ -228,6 +327,192 @@ def api_get_requests():
         return (output, 200, {'Content-type': 'application/json'})
 
 
+def export_allowed(db, client_id):
+    '''
+    Whether the API key (or address) can start another export, recording
+    it if so. Exports are logged with a TTL, so old ones drop off.
+    '''
+    now = datetime.datetime.utcnow()
+    period_start = now - datetime.timedelta(seconds=app.config['EXPORT_RATE_PERIOD'])
+    # record this export first, then count it and the ones before it, so
+    # simultaneous requests can't all see room for one more
+    export_id = db[COLLECTION_EXPORTS].insert({'client': client_id, 'time': now})
+    recent = db[COLLECTION_EXPORTS].find({'client': client_id, 'time': {'$gte': period_start}, '_id': {'$lte': export_id}}).count()
+    if recent > app.config['EXPORT_RATE_LIMIT']:
+        db[COLLECTION_EXPORTS].remove(export_id)
+        return False
+    return True
+
+
+def export_cases(query, order_by, legacy, compress):
+    '''
+    Yield every case matching the query, formatted as NDJSON, in chunks of
+    about EXPORT_CHUNK_SIZE bytes (gzipped if compress). Uses its own
+    connection, since it runs after the view has returned.
+    '''
+    def json_formatter(obj):
+        if isinstance(obj, datetime.datetime):
+            return obj.isoformat()
+        raise TypeError(repr(o) + " is not JSON serializable")
+    
+    # 16 + MAX_WBITS makes zlib write a gzip header and trailer
+    compressor = compress and zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) or None
+    with closing(connect_db()) as db:
+        actual_db = db[DB_NAME]
+        # the search text is only for searching and makes up much of a case
+        srs = actual_db[COLLECTION_CASES].find(query, {CASE_SEARCH_FIELD: 0})
+        srs = srs.sort(order_by, pymongo.DESCENDING).batch_size(app.config['EXPORT_BATCH_SIZE'])
+        # services and outcomes, looked up once each for the whole export
+        cache = {}
+        lines = []
+        size = 0
+        for sr in srs:
+            line = json.dumps(sr_format.format_case(sr, actual_db, legacy=legacy, cache=cache), default=json_formatter)
+            lines.append(line)
+            size += len(line) + 1
+            if size >= app.config['EXPORT_CHUNK_SIZE']:
+                chunk = '\n'.join(lines) + '\n'
+                lines = []
+                size = 0
+                if compressor:
+                    chunk = compressor.compress(chunk)
+                if chunk:
+                    yield chunk
+        
+        chunk = lines and '\n'.join(lines) + '\n' or ''
+        if compressor:
+            chunk = compressor.compress(chunk) + compressor.flush()
+        if chunk:
+            yield chunk
+
+
+@app.route("/api/requests/export.ndjson")
+def api_export_requests():
+    # every case /api/requests.json would page through, in one streamed response
+    legacy = parse_bool(request.args.get('legacy', True))
+    try:
+        query, order_by = requests_query()
+    except ValueError, e:
+        return bad_request(str(e))
+    
+    with closing(connect_db()) as db:
+        # unknown keys are made up for free, so those are limited by address
+        client_id = g.api_key or request.remote_addr
+        if not export_allowed(db[DB_NAME], client_id):
+            return make_response(
+                json.dumps({'error': 'Too many exports; at most %s per %s seconds are allowed.' % (app.config['EXPORT_RATE_LIMIT'], app.config['EXPORT_RATE_PERIOD'])}),
+                429,
+                {'Content-type': 'application/json', 'Retry-After': str(app.config['EXPORT_RATE_PERIOD'])})
+    
+    compress = request.accept_encodings['gzip'] > 0
+    headers = compress and {'Content-Encoding': 'gzip'} or {}
+    return Response(export_cases(query, order_by, legacy, compress), mimetype='application/x-ndjson', headers=headers)
+
+
+@app.route("/api/changes.json")
+def api_changes():
+    # changes to cases after the since token (from the last response), oldest first
+    since = request.args.get('since')
+    if since is not None and not since.isdigit():
+        return bad_request('"since" must be a token from a previous response')
+    page_size = app.config['DEFAULT_PAGE_SIZE']
+    if 'page_size' in request.args and request.args['page_size'].isdigit():
+        page_size = min(app.config['MAX_PAGE_SIZE'], int(request.args['page_size'])) or page_size
+    legacy = parse_bool(request.args.get('legacy', True))
+    
+    with closing(connect_db()) as db:
+        actual_db = db[DB_NAME]
+        # without a token, start from now (e.g. after loading everything from /api/requests.json)
+        if since is None:
+            output = {'next': str(changes.start_sequence(actual_db, app.config['CHANGES_GRACE_SECONDS'])), 'more': False, 'requests': [], 'removed': []}
+            return (json.dumps(output), 200, {'Content-type': 'application/json'})
+        
+        found = changes.changes_since(actual_db, int(since), page_size, app.config['CHANGES_GRACE_SECONDS'])
+        if found is None:
+            return make_response(
+                json.dumps({'error': 'Changes since this token have expired; reload from /api/requests.json'}),
+                410,
+                {'Content-type': 'application/json'})
+        page, next_sequence, more = found
+        
+        latest = changes.latest_changes(page)
+        case_ids = [change['case'] for change in latest if change['op'] != changes.REMOVED]
+        cases = {}
+        if case_ids:
+            for sr_case in actual_db[COLLECTION_CASES].find({'_id': {'$in': case_ids}, 'service_code': {'$in': g.accepted_services}}):
+                cases[sr_case['_id']] = sr_case
+        
+        data = []
+        removed = []
+        for change in latest:
+            if change['case'] in cases:
+                data.append(sr_format.format_case(cases[change['case']], actual_db, legacy=legacy))
+            elif change['op'] == changes.REMOVED and change.get('service_code') in g.accepted_services:
+                removed.append({'service_request_id': change['case'], 'merged_into': change.get('merged_into')})
+        
+        def json_formatter(obj):
+            if isinstance(obj, datetime.datetime):
+                return obj.isoformat()
+            raise TypeError(repr(o) + " is not JSON serializable")
+        
+        output = {
+            'next': str(next_sequence),
+            'more': more,
+            'requests': data,
+            'removed': removed,
+        }
+        return (json.dumps(output, default=json_formatter), 200, {'Content-type': 'application/json'})
+
+
+@app.route("/api/analytics/follow_ons.json")
+def api_follow_ons():
+    # paths per service code, most common first
+    max_paths = app.config['MAX_FOLLOW_ON_PATHS']
+    if 'max_paths' in request.args and request.args['max_paths'].isdigit():
+        max_paths = min(max_paths, int(request.args['max_paths'])) or max_paths
+    
+    service_code = flattened_arg_list('service_code')
+    # limit service codes to the accepted ones
+    if service_code:
+        service_code = filter(lambda code: code in g.accepted_services, service_code)
+    else:
+        service_code = list(g.accepted_services)
+    
+    with closing(connect_db()) as db:
+        actual_db = db[DB_NAME]
+        data = analytics.follow_ons_for_services(actual_db, service_code, max_paths)
+        return (json.dumps(data), 200, {'Content-type': 'application/json'})
+
+
+@app.route("/api/stats.json")
+def api_stats():
+    # counts of cases by any combination of analytics.STATS_DIMENSIONS
+    group_by = flattened_arg_list('group_by') or []
+    for dimension in group_by:
+        if dimension not in analytics.STATS_DIMENSIONS:
+            return bad_request('"group_by" must be some of: %s' % ', '.join(analytics.STATS_DIMENSIONS))
+    
+    service_code = flattened_arg_list('service_code')
+    # limit service codes to the accepted ones
+    if service_code:
+        service_code = filter(lambda code: code in g.accepted_services, service_code)
+    else:
+        service_code = list(g.accepted_services)
+    
+    # days requested, inclusive
+    start_date = request.args.get('start_date', type=parse_date)
+    end_date = request.args.get('end_date', type=parse_date)
+    
+    with closing(connect_db()) as db:
+        actual_db = db[DB_NAME]
+        data = analytics.case_stats(actual_db, group_by, service_code,
+            statuses=flattened_arg_list('status'),
+            wards=flattened_arg_list('ward'),
+            start_day=start_date and start_date.date().isoformat(),
+            end_day=end_date and end_date.date().isoformat())
+        return (json.dumps(data), 200, {'Content-type': 'application/json'})
+
+
 @app.route("/receive", methods=['POST'])
 def receive():
     data = request.json
@@ -237,12 +522,25 @@ def receive():
     
     with closing(connect_db()) as db:
         actual_db = db[DB_NAME]
+        # cases the SRs may be merged out of...
+        touched_cases = analytics.touched_case_ids(data, actual_db)
         for sr in data:
             try:
                 save_sr_data(sr, actual_db)
             except Exception, e:
                 # print '!! Receive error: %s' % e.message
                 traceback.print_exc()
+        
+        # ...and the ones they're in now
+        try:
+            touched_cases.update(analytics.touched_case_ids(data, actual_db))
+            analytics.refresh_follow_on_paths(actual_db, touched_cases)
+        except Exception, e:
+            traceback.print_exc()
+        try:
+            changes.expire_changes(actual_db, app.config['CHANGES_TTL_DAYS'])
+        except Exception, e:
+            traceback.print_exc()
     
     return ""
 
@@ -0,0 +1,124 @@
+'''
+Benchmark lat/long/radius and bbox queries like /api/requests.json makes,
+with the 2dsphere index on cases and forced to scan the whole collection,
+on a scratch database filled with synthetic cases spread over the city.
+
+    python benchmark_geo.py --cases 1000000 --queries 50 --radius 400
+'''
+
+import datetime
+import random
+import time
+from contextlib import closing
+from optparse import OptionParser
+import pymongo
+import app
+import geo
+from accepted_services import ACCEPTED_SERVICES
+from db_info import *
+
+# Roughly the city limits
+CHICAGO_BOUNDS = (41.64, -87.94, 42.02, -87.52)
+STATUSES = ('open', 'closed')
+
+
+def load_synthetic(collection, count, seed=311):
+    '''Insert cases with just the fields the list endpoint filters and sorts on.'''
+    rand = random.Random(seed)
+    south, west, north, east = CHICAGO_BOUNDS
+    start = datetime.datetime(2012, 1, 1)
+    collection.drop()
+    batch = []
+    for index in xrange(count):
+        requested = start + datetime.timedelta(minutes=rand.randint(0, 525600))
+        case = {
+            '_id': '12-%08d' % index,
+            'service_code': rand.choice(ACCEPTED_SERVICES),
+            'status': rand.choice(STATUSES),
+            'requested_datetime': requested,
+            'updated_datetime': requested + datetime.timedelta(days=rand.randint(0, 30)),
+        }
+        # some cases never get coordinates
+        if rand.random() < 0.95:
+            case[CASE_GEO_FIELD] = {'type': 'Point', 'coordinates': [rand.uniform(west, east), rand.uniform(south, north)]}
+        batch.append(case)
+        if len(batch) >= 1000:
+            collection.insert(batch)
+            batch = []
+    if batch:
+        collection.insert(batch)
+    collection.ensure_index([(CASE_GEO_FIELD, pymongo.GEOSPHERE)])
+
+
+def random_points(count, seed=311):
+    rand = random.Random(seed)
+    south, west, north, east = CHICAGO_BOUNDS
+    return [(rand.uniform(south, north), rand.uniform(west, east)) for index in xrange(count)]
+
+
+def query_plan(cursor):
+    '''(plan, documents examined) from either the old or new explain() format.'''
+    explanation = cursor.explain()
+    if 'cursor' in explanation:
+        return explanation['cursor'], explanation.get('nscannedObjects')
+    stages = []
+    stage = explanation['queryPlanner']['winningPlan']
+    while stage:
+        stages.append(stage['stage'])
+        stage = stage.get('inputStage')
+    return ' > '.join(stages), explanation.get('executionStats', {}).get('totalDocsExamined')
+
+
+def run_queries(collection, queries, page_size, hint=None):
+    '''Average milliseconds for a page of each query, and the total number of results.'''
+    results = 0
+    start = time.time()
+    for query in queries:
+        cursor = collection.find(query, ['_id']).sort('requested_datetime', pymongo.DESCENDING).limit(page_size)
+        if hint:
+            cursor = cursor.hint(hint)
+        results += len(list(cursor))
+    return (time.time() - start) * 1000 / len(queries), results
+
+
+def compare(name, collection, queries, page_size):
+    indexed, indexed_results = run_queries(collection, queries, page_size)
+    scanned, scanned_results = run_queries(collection, queries, page_size, [('$natural', 1)])
+    assert indexed_results == scanned_results, 'The index found %s results but a scan found %s' % (indexed_results, scanned_results)
+    plan, examined = query_plan(collection.find(queries[0]))
+    scan_plan, scan_examined = query_plan(collection.find(queries[0]).hint([('$natural', 1)]))
+    print '%s:' % name
+    print '    2dsphere index: %8.2f ms/page  %-30s %s docs examined' % (indexed, plan, examined)
+    print '    full scan:      %8.2f ms/page  %-30s %s docs examined' % (scanned, scan_plan, scan_examined)
+    print '    %.1fx faster with the index' % (scanned / indexed)
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("-n", "--cases", dest="cases", default=200000, type="int", help="Number of synthetic cases")
+    parser.add_option("-q", "--queries", dest="queries", default=20, type="int", help="Number of queries of each kind")
+    parser.add_option("-r", "--radius", dest="radius", default=500, type="float", help="Radius of lat/long queries in meters")
+    parser.add_option("--box", dest="box", default=0.01, type="float", help="Height and width of bbox queries in degrees")
+    parser.add_option("--db", dest="db", default=app.DB_NAME + 'Benchmark', help="Scratch database to fill (dropped afterward)")
+    (options, args) = parser.parse_args()
+
+    app.app.config.from_object(app)
+    with closing(app.connect_db()) as connection:
+        collection = connection[options.db][COLLECTION_CASES]
+        print 'Inserting %s synthetic cases...' % options.cases
+        load_synthetic(collection, options.cases)
+
+        points = random_points(options.queries)
+        services = {'$in': list(ACCEPTED_SERVICES[:5])}
+        compare('Within %sm' % options.radius, collection,
+            [{CASE_GEO_FIELD: geo.radius_query(latitude, longitude, options.radius)} for latitude, longitude in points],
+            app.DEFAULT_PAGE_SIZE)
+        compare('Within %sm, 5 services, open' % options.radius, collection,
+            [{CASE_GEO_FIELD: geo.radius_query(latitude, longitude, options.radius), 'service_code': services, 'status': {'$in': ['open']}}
+                for latitude, longitude in points],
+            app.DEFAULT_PAGE_SIZE)
+        half = options.box / 2
+        compare('Within a %s degree bbox' % options.box, collection,
+            [{CASE_GEO_FIELD: geo.bbox_query(longitude - half, latitude - half, longitude + half, latitude + half)} for latitude, longitude in points],
+            app.DEFAULT_PAGE_SIZE)
+        connection.drop_database(options.db)
@@ -0,0 +1,120 @@
+'''
+A log of changes to cases, so mirrors can sync just what changed since they
+last looked (see /api/changes.json). Each change gets a sequence number from
+a counter; a change's sequence number is the token for everything after it.
+Changes expire after a while (see expire_changes()), so mirrors that fall
+too far behind have to start over. The highest expired sequence number is
+kept with the counter, so expired tokens can be told apart from gaps left
+by writers that failed.
+
+Sequence numbers are handed out before the changes are written, so with
+more than one writer a change can show up before ones numbered lower than
+it. Tokens never go past a recent gap in the numbers (see changes_since()),
+so a mirror doesn't skip changes that were still being written.
+'''
+
+import datetime
+import pymongo
+from db_info import *
+
+CREATED = 'created'
+UPDATED = 'updated'
+REMOVED = 'removed'
+
+
+def next_sequence(db):
+    counter = db[COLLECTION_COUNTERS].find_and_modify(
+        {'_id': COLLECTION_CHANGES},
+        {'$inc': {'sequence': 1}},
+        upsert=True,
+        new=True)
+    return counter['sequence']
+
+
+def last_sequence(db):
+    counter = db[COLLECTION_COUNTERS].find_one({'_id': COLLECTION_CHANGES})
+    return counter and counter['sequence'] or 0
+
+
+def expired_sequence(db):
+    counter = db[COLLECTION_COUNTERS].find_one({'_id': COLLECTION_CHANGES})
+    return counter and counter.get('expired') or 0
+
+
+def expire_changes(db, ttl_days):
+    '''
+    Remove the changes older than ttl_days, recording the highest sequence
+    number removed first, so tokens before it are known to have expired.
+    '''
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=ttl_days)
+    newest = list(db[COLLECTION_CHANGES].find({'time': {'$lt': cutoff}}, ['_id']).sort('_id', pymongo.DESCENDING).limit(1))
+    if not newest:
+        return
+    expired = newest[0]['_id']
+    db[COLLECTION_COUNTERS].update({'_id': COLLECTION_CHANGES}, {'$max': {'expired': expired}}, upsert=True)
+    db[COLLECTION_CHANGES].remove({'_id': {'$lte': expired}})
+
+
+def record_change(db, case_id, service_code, operation, merged_into=None):
+    '''Log that a case was created, updated or removed (maybe by merging it into another case).'''
+    change = {
+        '_id': next_sequence(db),
+        'case': case_id,
+        'service_code': service_code,
+        'op': operation,
+        'time': datetime.datetime.utcnow(),
+    }
+    if merged_into:
+        change['merged_into'] = merged_into
+    db[COLLECTION_CHANGES].insert(change)
+
+
+def start_sequence(db, grace_seconds):
+    '''
+    A token to start from for a mirror that's up to date now: the last
+    change from before the grace period, since changes in it might still
+    be being written. (Changes in the grace period get sent again, which
+    is harmless.)
+    '''
+    settled = datetime.datetime.utcnow() - datetime.timedelta(seconds=grace_seconds)
+    older = list(db[COLLECTION_CHANGES].find({'time': {'$lt': settled}}, ['_id']).sort('_id', pymongo.DESCENDING).limit(1))
+    if older:
+        return older[0]['_id']
+    oldest = list(db[COLLECTION_CHANGES].find({}, ['_id']).sort('_id', pymongo.ASCENDING).limit(1))
+    if oldest:
+        return oldest[0]['_id'] - 1
+    return last_sequence(db)
+
+
+def changes_since(db, since, limit, grace_seconds):
+    '''
+    Up to limit changes after the since sequence number, oldest first, as
+    (changes, next sequence number, whether there are more). Returns None if
+    changes after since have already expired.
+    
+    Stops at the first gap in the sequence numbers that's followed by a
+    change from the last grace_seconds, since the missing change might
+    still be being written. Older gaps are from writers that failed.
+    '''
+    if since < expired_sequence(db):
+        return None
+    changes = list(db[COLLECTION_CHANGES].find({'_id': {'$gt': since}}).sort('_id', pymongo.ASCENDING).limit(limit))
+    more = len(changes) == limit
+    
+    settled = datetime.datetime.utcnow() - datetime.timedelta(seconds=grace_seconds)
+    expected = since + 1
+    for index, change in enumerate(changes):
+        if change['_id'] != expected and change['time'] > settled:
+            changes = changes[:index]
+            more = True
+            break
+        expected = change['_id'] + 1
+    return changes, changes and changes[-1]['_id'] or since, more
+
+
+def latest_changes(changes):
+    '''The last of the changes to each case, in the order they happened.'''
+    latest = {}
+    for change in changes:
+        latest[change['case']] = change
+    return sorted(latest.values(), key=lambda change: change['_id'])
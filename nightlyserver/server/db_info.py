@@ -6,3 +6,20 @@ COLLECTION_ORPHANS    = 'OrphanCases'
 COLLECTION_SERVICES   = 'Services'
 COLLECTION_API_KEYS   = 'APIKeys'
 COLLECTION_OUTCOMES   = 'Outcomes'
+
+# GeoJSON point field on cases, with a 2dsphere index (see geo.py and manage.py)
+CASE_GEO_FIELD = 'geo_location'
+# Text from the SRs' and activities' details on cases, with a text index (see manage.py)
+CASE_SEARCH_FIELD = 'search_text'
+
+# Analytics rollups (see analytics.py)
+COLLECTION_FOLLOW_ON_PATHS = 'FollowOnPaths'
+COLLECTION_FOLLOW_ON_CASES = 'FollowOnPathCases'
+COLLECTION_CASE_STATS      = 'CaseStats'
+
+# Log of changes to cases and the counter for their sequence numbers (see changes.py)
+COLLECTION_CHANGES  = 'CaseChanges'
+COLLECTION_COUNTERS = 'Counters'
+
+# Recent bulk exports, for rate limiting them per API key
+COLLECTION_EXPORTS = 'Exports'
@@ -0,0 +1,34 @@
+'''Geospatial helpers: GeoJSON points for cases and queries against them.'''
+
+# Mean radius of the earth, for turning distances into radians
+EARTH_RADIUS_METERS = 6371000.0
+
+
+def case_point(sr):
+    '''
+    A GeoJSON point for an SR's coordinates (which the collector projects to
+    longitude/latitude), or None if they're missing or aren't longitude and
+    latitude (e.g. if the collector had no projection configured).
+    '''
+    try:
+        longitude = float(sr['srs-X_COORDINATE'])
+        latitude = float(sr['srs-Y_COORDINATE'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if not (-180 <= longitude <= 180 and -90 <= latitude <= 90) or (longitude == 0 and latitude == 0):
+        return None
+    return {'type': 'Point', 'coordinates': [longitude, latitude]}
+
+
+def radius_query(latitude, longitude, radius):
+    '''A query for cases within radius meters of a point.'''
+    return {'$geoWithin': {'$centerSphere': [[longitude, latitude], radius / EARTH_RADIUS_METERS]}}
+
+
+def bbox_query(west, south, east, north):
+    '''
+    A query for cases within a bounding box. The box's edges are geodesics,
+    not lines of latitude, but at city scale the difference is negligible.
+    '''
+    corners = [[west, south], [east, south], [east, north], [west, north], [west, south]]
+    return {'$geoWithin': {'$geometry': {'type': 'Polygon', 'coordinates': [corners]}}}
@@ -2,6 +2,9 @@ import json
 import uuid
 from dateutil.parser import parse as parse_date
 from db_info import *
+from geo import case_point
+import analytics
+import changes
 
 def save_sr_data(sr, db):
     sr = clean_document(sr)
@@ -21,6 +24,7 @@ def save_sr_data(sr, db):
                     orphan = True
                     if not case_data:
                         raise Exception('Indexed case (%s) could not be found' % json.dumps(parent_case_id))
+                stats_before = case_stats_key(case_data, orphan)
                 
                 # add to case and index
                 case_data['requests'].append(sr)
@@ -31,6 +35,7 @@ def save_sr_data(sr, db):
                 
                 collection = db[orphan and COLLECTION_ORPHANS or COLLECTION_CASES]
                 collection.save(case_data)
+                case_saved(db, case_data, stats_before, orphan)
                 db[COLLECTION_CASE_INDEX].insert({
                     '_id': sr['srs-SERVICE_REQUEST_NUM'],
                     'EID': sr['srs-EID'],
@@ -75,6 +80,7 @@ def save_sr_data(sr, db):
             update_case_metadata(case_data)
             # since it's the root, it's not orphaned
             case_id_str = db[COLLECTION_CASES].insert(case_data)
+            case_saved(db, case_data, None)
             # insert into index
             db[COLLECTION_CASE_INDEX].insert({
                 '_id': sr['srs-SERVICE_REQUEST_NUM'],
@@ -93,6 +99,7 @@ def save_sr_data(sr, db):
             orphan = True
             if not case_data:
                 raise Exception('Indexed case (%s) could not be found' % json.dumps(case_id))
+        stats_before = case_stats_key(case_data, orphan)
         
         if sr['srs-CREATION_REASON_CODE'] == 'FOLLOW_O':
             # follow-on
@@ -115,6 +122,7 @@ def save_sr_data(sr, db):
                     parent_case_data = db[COLLECTION_ORPHANS].find_one({'_id': parent_case_id_str})
                     if not parent_case_data:
                         raise Exception('Indexed case (%s) could not be found' % json.dumps(parent_case_id))
+                parent_stats_before = case_stats_key(parent_case_data, parent_orphan)
                 # add known case requests to parent case
                 parent_case_data['requests'].extend(case_data['requests'])
                 # update metadata on case if it's not an orphan
@@ -122,11 +130,13 @@ def save_sr_data(sr, db):
                     update_case_metadata(parent_case_data)
                 # save parent
                 db[parent_orphan and COLLECTION_ORPHANS or COLLECTION_CASES].save(parent_case_data)
+                case_saved(db, parent_case_data, parent_stats_before, parent_orphan)
                 # update indices
                 for subrequest in case_data['requests']:
                     db[COLLECTION_CASE_INDEX].update({'EID': subrequest['srs-EID']}, {'$set': {'case': parent_case_id_str}})
                 # remove known case
                 db[orphan and COLLECTION_ORPHANS or COLLECTION_CASES].remove(case_data['_id'])
+                case_removed(db, case_data['_id'], stats_before, not parent_orphan and parent_case_id_str or None)
                 
             else:
                 # update metadata on case if it's not an orphan
@@ -134,6 +144,7 @@ def save_sr_data(sr, db):
                     update_case_metadata(case_data)
                 # save case
                 db[orphan and COLLECTION_ORPHANS or COLLECTION_CASES].save(case_data)
+                case_saved(db, case_data, stats_before, orphan)
                 # index the parent for this case
                 db[COLLECTION_CASE_INDEX].insert({
                     '_id': str(sr['srs-ORIG_SERVICE_REQUEST_EID']),
@@ -162,6 +173,7 @@ def save_sr_data(sr, db):
                 update_case_metadata(parent_case_data)
                 # insert new case
                 parent_case_id_str = db[COLLECTION_CASES].save(parent_case_data)
+                case_saved(db, parent_case_data, None)
                 # update indices (need to update ALL, not just the orphan case's, since we already matched this one)
                 for subrequest in parent_case_data['requests']:
                     db[COLLECTION_CASE_INDEX].update({'EID': subrequest['srs-EID']}, {'$set': {'case': parent_case_id_str}})
@@ -182,6 +194,7 @@ def save_sr_data(sr, db):
                 # update metadata on case
                 update_case_metadata(case_data)
                 db[COLLECTION_CASES].save(case_data)
+                case_saved(db, case_data, stats_before)
 
 
 def update_case_metadata(sr_case):
@@ -200,9 +213,56 @@ def update_case_metadata(sr_case):
     sr_case['updated_datetime'] = last['srs-UPDATED_DATE'];
     sr_case['priority'] = first['srs-PRIORITY_CODE'];
     sr_case['location'] = [first['srs-X_COORDINATE'], first['srs-Y_COORDINATE']];
+    # 'location' can hold anything; this is only set when it's a real point (for the 2dsphere index)
+    point = case_point(first)
+    if point:
+        sr_case[CASE_GEO_FIELD] = point
+    else:
+        sr_case.pop(CASE_GEO_FIELD, None)
     # A case is open if any SRs in it are open (since some follow-ons are branching, this matters)
     open_srs = filter(lambda sr: sr['srs-STATUS_CODE'].startswith('O'), sr_case['requests'])
     sr_case['status'] = len(open_srs) > 0 and 'open' or 'closed'
+    sr_case[CASE_SEARCH_FIELD] = case_search_text(sr_case)
+
+
+def case_search_text(sr_case):
+    '''All the details of a case's SRs and their activities, for full-text search.'''
+    text = []
+    for sr in sr_case['requests']:
+        if sr.get('srs-DETAILS'):
+            text.append(sr['srs-DETAILS'])
+        for activity in sr.get('activities', []):
+            if activity.get('act-DETAILS'):
+                text.append(activity['act-DETAILS'])
+    return '\n'.join(text)
+
+
+def case_stats_key(sr_case, orphan=False):
+    '''The case's key for analytics.count_case_stats(); orphans aren't counted.'''
+    if orphan:
+        return None
+    return analytics.case_stats_key(sr_case)
+
+
+def case_saved(db, sr_case, stats_before, orphan=False):
+    '''
+    Update the stats and change log for a case that was just saved. Takes
+    its case_stats_key() from before it changed, which is None if it wasn't
+    a case (i.e. it's new or was an orphan). Orphans aren't public, so
+    they're left out.
+    '''
+    if orphan:
+        return
+    analytics.count_case_stats(db, stats_before, case_stats_key(sr_case))
+    changes.record_change(db, sr_case['_id'], sr_case['service_code'], stats_before and changes.UPDATED or changes.CREATED)
+
+
+def case_removed(db, case_id, stats_before, merged_into=None):
+    '''Update the stats and change log for a case that was removed (see case_saved()).'''
+    if not stats_before:
+        return
+    analytics.count_case_stats(db, stats_before, None)
+    changes.record_change(db, case_id, stats_before['service_code'], changes.REMOVED, merged_into)
 
 
 def find_sr_in_list(sr, sr_list):
@@ -0,0 +1,97 @@
+'''
+Maintenance commands for the server's database: rebuilding rollups and
+derived fields from the Cases collection (e.g. after first deploying them).
+--locations and --search also create the indexes that lat/long/bbox and q=
+queries need, in the background, once the fields are filled in; --indexes
+creates the others the API needs (run it again after changing their
+settings in app.py).
+
+    python manage.py --indexes --followons --stats --locations --search
+'''
+
+from contextlib import closing
+from optparse import OptionParser
+import pymongo
+import app
+import analytics
+from db_info import *
+from geo import case_point
+from handle_srs import case_search_text
+
+
+def set_case_locations(db):
+    '''Set (or clear) the GeoJSON point of every case from its first SR and index them.'''
+    for sr_case in db[COLLECTION_CASES].find({}, ['requests.srs-X_COORDINATE', 'requests.srs-Y_COORDINATE']):
+        point = case_point(sr_case['requests'][0])
+        if point:
+            db[COLLECTION_CASES].update({'_id': sr_case['_id']}, {'$set': {CASE_GEO_FIELD: point}})
+        else:
+            db[COLLECTION_CASES].update({'_id': sr_case['_id']}, {'$unset': {CASE_GEO_FIELD: 1}})
+    db[COLLECTION_CASES].ensure_index([(CASE_GEO_FIELD, pymongo.GEOSPHERE)], background=True)
+
+
+def ensure_time_index(collection, field, expire_seconds=None):
+    '''
+    Create an index on a date field, with a TTL if expire_seconds is given,
+    replacing one with a different expiry (e.g. after a config change).
+    '''
+    name = '%s_1' % field
+    index = collection.index_information().get(name)
+    if index and index.get('expireAfterSeconds') != expire_seconds:
+        collection.drop_index(name)
+    if expire_seconds is None:
+        collection.ensure_index(field, background=True)
+    else:
+        collection.ensure_index(field, expireAfterSeconds=expire_seconds, background=True)
+
+
+def create_indexes(db):
+    '''
+    Create the indexes the API needs (besides the ones --locations and
+    --search make): the fields cases are sorted by (so exports don't sort
+    in memory), in the background, the rollups', the change log's and the
+    export rate limit's. Run it again after changing EXPORT_RATE_PERIOD.
+    '''
+    db[COLLECTION_CASES].ensure_index('requested_datetime', background=True)
+    db[COLLECTION_CASES].ensure_index('updated_datetime', background=True)
+    analytics.ensure_analytics_indexes(db)
+    # changes are expired by changes.expire_changes(), which records what it removed
+    ensure_time_index(db[COLLECTION_CHANGES], 'time')
+    ensure_time_index(db[COLLECTION_EXPORTS], 'time', app.app.config['EXPORT_RATE_PERIOD'])
+
+
+def set_case_search_text(db):
+    '''Set the full-text search field of every case and index it.'''
+    fields = ['requests.srs-DETAILS', 'requests.activities.act-DETAILS']
+    for sr_case in db[COLLECTION_CASES].find({}, fields):
+        db[COLLECTION_CASES].update({'_id': sr_case['_id']}, {'$set': {CASE_SEARCH_FIELD: case_search_text(sr_case)}})
+    db[COLLECTION_CASES].ensure_index([(CASE_SEARCH_FIELD, pymongo.TEXT)], background=True)
+
+
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option("--indexes", dest="indexes", action="store_true", help="Create the indexes the API needs", default=False)
+    parser.add_option("--followons", dest="follow_ons", action="store_true", help="Rebuild the follow-on paths rollup", default=False)
+    parser.add_option("--stats", dest="stats", action="store_true", help="Rebuild the case stats rollup", default=False)
+    parser.add_option("--locations", dest="locations", action="store_true", help="Set the GeoJSON location of every case", default=False)
+    parser.add_option("--search", dest="search", action="store_true", help="Set the full-text search field of every case", default=False)
+    (options, args) = parser.parse_args()
+
+    app.app.config.from_object(app)
+    with closing(app.connect_db()) as connection:
+        db = connection[app.DB_NAME]
+        if options.indexes:
+            print 'Creating indexes...'
+            create_indexes(db)
+        if options.locations:
+            print 'Setting case locations...'
+            set_case_locations(db)
+        if options.search:
+            print 'Setting case search text...'
+            set_case_search_text(db)
+        if options.follow_ons:
+            print 'Rebuilding follow-on paths...'
+            analytics.rebuild_follow_on_paths(db)
+        if options.stats:
+            print 'Rebuilding case stats...'
+            analytics.rebuild_case_stats(db)
@@ -18,11 +18,12 @@ def format_address(sr, regional=False):
     return address
 
 
-def format_case(sr_case, db, legacy=False):
-    '''Format a case as an Open311 Service Request'''
+def format_case(sr_case, db, legacy=False, cache=None):
+    '''Format a case as an Open311 Service Request. Pass the same cache dict
+    when formatting many cases to look each service and outcome up only once.'''
     
     # create the notes list
-    notes = notes_for_case(sr_case, db)
+    notes = notes_for_case(sr_case, db, cache=cache)
     
     # is the whole case closed?
     last_sr = sr_case['requests'][-1]
@@ -53,8 +54,8 @@ def format_case(sr_case, db, legacy=False):
         'agency_responsible': base_sr['codes_group-DESCRIPTION'],
         'status': overall_status,
         'status_notes': status_notes,
-        'service_name': get_service_by_code(base_sr['srs-TYPE_CODE'], db),
-        'service_code': get_service_uuid_by_code(base_sr['srs-TYPE_CODE'], db),
+        'service_name': get_service_by_code(base_sr['srs-TYPE_CODE'], db, cache),
+        'service_code': get_service_uuid_by_code(base_sr['srs-TYPE_CODE'], db, cache),
         'description': base_sr['srs-DETAILS'],
         'requested_datetime': base_sr['srs-CREATED_DATE'],
         'updated_datetime': last_sr['srs-UPDATED_DATE'],
@@ -80,7 +81,7 @@ def format_case(sr_case, db, legacy=False):
     
     # old (non-CB) style
     if legacy:
-        sr['activities'] = notes_for_case(sr_case, db, legacy=True)
+        sr['activities'] = notes_for_case(sr_case, db, legacy=True, cache=cache)
         sr['received_via'] = base_sr['srs-METHOD_RECEIVED_CODE']
         if overall_status == 'closed':
             # add an activity for closing the case
@@ -93,7 +94,7 @@ def format_case(sr_case, db, legacy=False):
     return sr
 
 
-def notes_for_case(sr_case, db, legacy=False):
+def notes_for_case(sr_case, db, legacy=False, cache=None):
     '''Generate a list of notes based on CSR activities and follow-ons'''
     
     notes = []
@@ -108,7 +109,7 @@ def notes_for_case(sr_case, db, legacy=False):
                 })
         else:
             # create an activity to represent a follow-on
-            service_name = get_service_by_code(subrequest['srs-TYPE_CODE'], db) or subrequest['srs-TYPE_CODE']
+            service_name = get_service_by_code(subrequest['srs-TYPE_CODE'], db, cache) or subrequest['srs-TYPE_CODE']
             note = {
                 'datetime': subrequest['srs-CREATED_DATE'],
                 'type': legacy and 'subrequest' or 'follow_on',
@@ -150,12 +151,12 @@ def notes_for_case(sr_case, db, legacy=False):
                         note['properties']['details'] = sr_activity['act-DETAILS']
                 else:
                     note['summary'] = sr_activity['codes_act-DESCRIPTION']
-                    note['description'] = get_outcome_by_code(sr_activity['act-OUTCOME_CODE'], db)
+                    note['description'] = get_outcome_by_code(sr_activity['act-OUTCOME_CODE'], db, cache)
                 notes.append(note)
         
         # CB style has a note for subrequest closure
         if not legacy and subrequest['srs-STATUS_CODE'].startswith('O') == False and index > 0:
-            service_name = get_service_by_code(subrequest['srs-TYPE_CODE'], db) or subrequest['srs-TYPE_CODE']
+            service_name = get_service_by_code(subrequest['srs-TYPE_CODE'], db, cache) or subrequest['srs-TYPE_CODE']
             note = {
                 'datetime': subrequest['srs-UPDATED_DATE'],
                 'type': 'follow_on',
@@ -175,22 +176,32 @@ def notes_for_case(sr_case, db, legacy=False):
     return notes
 
 
-def get_service_by_code(code, db):
+def find_by_code(collection, code, db, cache=None):
+    """Find a service or outcome by code, remembering it in cache (a dict) if given."""
+    if cache is None:
+        return db[collection].find_one({'_id': code})
+    key = (collection, code)
+    if key not in cache:
+        cache[key] = db[collection].find_one({'_id': code})
+    return cache[key]
+
+
+def get_service_by_code(code, db, cache=None):
     """Get the service name associated with a service code."""
     # FIXME: this should probably cache the list of services instead of hitting the DB
-    service = db[COLLECTION_SERVICES].find_one({'_id': code})
+    service = find_by_code(COLLECTION_SERVICES, code, db, cache)
     return service and service['name'] or None
 
 
-def get_service_uuid_by_code(code, db):
+def get_service_uuid_by_code(code, db, cache=None):
     """Get the service name associated with a service code."""
     # FIXME: this should probably cache the list of services instead of hitting the DB
-    service = db[COLLECTION_SERVICES].find_one({'_id': code})
+    service = find_by_code(COLLECTION_SERVICES, code, db, cache)
     return service and service['uuid'] or None
    
-def get_outcome_by_code(code, db):
+def get_outcome_by_code(code, db, cache=None):
     """Get the outcome name associated with an outcome code."""
     # FIXME: this should probably cache the list of services instead of hitting the DB
-    outcome = db[COLLECTION_OUTCOMES].find_one({'_id': code})
+    outcome = find_by_code(COLLECTION_OUTCOMES, code, db, cache)
     return outcome and outcome['name'] or None
 